@@ -1,22 +1,107 @@
 import csv
 
+import time
+
+import random
+
+import threading
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from arcgis.gis import GIS
 
 # Define the CSV file path
 
 csv_file_path = r'C:\SOMECSV.csv'
 
+# Items fetched at once (requests keeps 10 connections per host, so stay at or below 10)
+
+max_workers = 8
+
+# Attempts per item before its size and view count are recorded as 'NA'
+
+max_attempts = 5
+
+# Throttling and server errors worth retrying; ArcGIS may also return these inside a JSON error
+
+retry_codes = (429, 500, 502, 503, 504)
+
 # Connect to your ArcGIS Online or Portal
 
 gis = GIS('home')
 
+# The signed-in session, shared (with its connection pool) by every worker thread
+
+session = gis.session
+
+counters = {'retries': 0, 'errors': 0}
+
+counters_lock = threading.Lock()
+
+
+class TransientError(Exception):
+
+    pass
+
+
+def fetch_details(item):
+
+    """Size and view count of one item from its item details, retrying transient failures with backoff"""
+
+    for attempt in range(max_attempts):
+
+        retry_after = None
+
+        try:
+
+            response = session.get(f"{gis.url}/sharing/rest/content/items/{item.id}", params={'f': 'json'}, timeout=60)
+
+            if response.status_code in retry_codes:
+
+                retry_after = response.headers.get('Retry-After')
+
+                raise TransientError(f"HTTP {response.status_code}")
+
+            details = response.json()
+
+            error = details.get('error')
+
+            if error and error.get('code') in retry_codes:
+
+                raise TransientError(error.get('message'))
+
+            if error:  # Not found, no access...: retrying won't help
+
+                raise RuntimeError(error.get('message'))
+
+            return details.get('size'), details.get('numViews')
+
+        except (TransientError, requests.ConnectionError, requests.Timeout, ValueError):
+
+            if attempt == max_attempts - 1:
+
+                raise
+
+            with counters_lock:
+
+                counters['retries'] += 1
+
+            # Exponential backoff with jitter so the workers don't retry in lockstep
+
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else min(30, 2 ** attempt)
+
+            time.sleep(delay * random.uniform(0.5, 1.0) + 0.5)
+
+
 # Get all items in the organization
 
 items = gis.content.search(query="",
                            max_items=10000, 
                            outside_org=False)
 
-# Write item names, item IDs, and view counts to the CSV file
+# Write item names, item IDs, and view counts to the CSV file as each item's details come back
 
 with open(csv_file_path, mode='w', newline='') as csv_file:
 
@@ -27,20 +112,41 @@ with open(csv_file_path, mode='w', newline='') as csv_file:
 
     writer.writeheader()
 
-    for item in items:
-        
-        try:
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        futures = {executor.submit(fetch_details, item): item for item in items}
+
+        for done, future in enumerate(as_completed(futures), 1):
+
+            item = futures[future]
+
+            try:
+
+                item_size, view_count = future.result()
+
+                item_size = item_size if item_size is not None else ''  # Set size to empty string if None
+
+            except Exception as e:
+
+                item_size = view_count = 'NA'
+
+                counters['errors'] += 1
+
+                print(f"\n{item.id} ({item.title}): {e}")
 
-            item_size = item.size if item.size is not None else ''  # Set size to empty string if None
+            writer.writerow({'Item Name': item.title,
+                             'Item Type': item.type, 
+                             'Item ID': item.id,
+                             'Item Size (Bytes)': item_size, 
+                             'View Count': view_count})
 
-        except:
+            if done % 50 == 0 or done == len(futures):
 
-            item_size = 'NA'
+                csv_file.flush()
 
-        writer.writerow({'Item Name': item.title,
-                         'Item Type': item.type, 
-                         'Item ID': item.id,
-                         'Item Size (Bytes)': item_size, 
-                         'View Count': item.numViews})
+                print(f"\r{done}/{len(futures)} items | {done / max(time.time() - start, 1e-6):.1f} items/s | "
+                      f"{counters['retries']} retries | {counters['errors']} errors", end='', flush=True)
 
-print(f"Item names, IDs, and view counts have been written to {csv_file_path}")
\ No newline at end of file
+print(f"\nItem names, IDs, and view counts have been written to {csv_file_path}")
\ No newline at end of file
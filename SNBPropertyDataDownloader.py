@@ -1,229 +1,1135 @@
 import os
 import sys
+import csv
+import argparse
 import requests
-import geopandas as gpd
-import pandas as pd
-import simplekml
+import zipfile
+import json
+import threading
+import time
+from datetime import datetime, timezone
 import xml.sax.saxutils as saxutils
-from PyQt6 import QtWidgets
-from PyQt6.QtWidgets import QFileDialog, QMessageBox, QLabel, QProgressBar, QTextEdit
-from PyQt6.QtCore import QThread, pyqtSignal
-
-def sanitize(value):
-    if isinstance(value, str):
-        return saxutils.escape(value)
-    return value
-
-class DataFetcher(QThread):
-    progress = pyqtSignal(int)
-    data_fetched = pyqtSignal(dict)
-    error_occurred = pyqtSignal(str)
-
-    def __init__(self, query, rest_service_url, max_record_count, total_count):
-        super().__init__()
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Next to this script: the page cache shares its on-disk store with the HTTP cache
+from httpCache import CachingAdapter, DiskStore
+
+# geopandas, pandas, numpy, shapely and PyQt6 are imported inside the functions that need them so
+# the headless CLI only loads what the requested output formats use
+
+REST_SERVICE_URL = "https://geonb.snb.ca/arcgis/rest/services/GeoNB_SNB_Pan/MapServer/0/query"
+
+# Number of pages requested at the same time when fetching concurrently
+MAX_WORKERS = 4
+
+def make_session(max_workers=MAX_WORKERS, http_cache=True):
+    """Keep-alive session with a connection pool big enough for every worker
+
+    With http_cache, layer metadata, count and ObjectID requests go through the on-disk cache shared with
+    the other REST scripts (httpCache.py).
+    """
+    session = requests.Session()
+    adapter = (CachingAdapter if http_cache else HTTPAdapter)(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Quantization used for f=pbf requests: full-extent "edit" mode, 1e-8 degrees is about a millimetre
+PBF_QUANTIZATION = {"mode": "edit", "originPosition": "upperLeft", "tolerance": 1e-8}
+
+def geometry_options(max_allowable_offset=None, geometry_precision=None, quantization_tolerance=None):
+    """Query parameters that let the server generalize and round geometry before sending it
+
+    max_allowable_offset and quantization_tolerance are in output units (degrees for SNB queries),
+    geometry_precision is the number of decimal places kept. Unset options keep full resolution.
+    """
+    options = {}
+    if max_allowable_offset:
+        options["maxAllowableOffset"] = max_allowable_offset
+    if geometry_precision is not None:
+        options["geometryPrecision"] = geometry_precision
+    if quantization_tolerance:
+        options["quantizationParameters"] = json.dumps({"mode": "edit", "originPosition": "upperLeft",
+                                                        "tolerance": quantization_tolerance})
+    return options
+
+def query_features(session, rest_service_url, params, transport="geojson", options=None):
+    """Run a feature query and return GeoJSON features, decoding the protobuf response for f=pbf"""
+    params = dict(params, **(options or {}))
+    if transport != "pbf":
+        response = session.get(rest_service_url, params=dict(params, f="geojson"))
+        response.raise_for_status()
+        return response.json().get("features", [])
+
+    import arcgisPbfDecoder
+
+    params = dict(params, f="pbf", outSR=4326)
+    params.setdefault("quantizationParameters", json.dumps(PBF_QUANTIZATION))
+    response = session.get(rest_service_url, params=params)
+    response.raise_for_status()
+    if "json" in response.headers.get("Content-Type", ""):
+        # Errors come back as JSON even when protobuf was requested
+        error = response.json().get("error", {})
+        raise RuntimeError(f"PBF query failed: {error.get('message', error)}")
+    return arcgisPbfDecoder.to_geojson_features(arcgisPbfDecoder.decode(response.content))
+
+class TransferCounter:
+    """requests response hook that totals the bytes received over the wire"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, response, *args, **kwargs):
+        if getattr(response, "from_cache", False):
+            return response  # Answered by the HTTP cache, nothing came over the wire
+        body = response.content  # Read the body so the raw stream position is final
+        with self.lock:
+            self.bytes += response.raw.tell() or len(body)
+        return response
+
+def count_transfer(session):
+    counter = TransferCounter()
+    session.hooks["response"].append(counter)
+    return counter
+
+def fetch_page(session, rest_service_url, query, offset, max_record_count, transport="geojson", options=None):
+    """Fetch one resultOffset page and return its GeoJSON features"""
+    params = {
+        "where": query,
+        "outFields": "*",  # Fetch all attributes
+        "resultOffset": offset,
+        "resultRecordCount": max_record_count
+    }
+    return query_features(session, rest_service_url, params, transport, options)
+
+def fetch_oid_range(session, rest_service_url, query, oid_field, first_oid, last_oid, transport="geojson",
+                    options=None):
+    """Fetch the features whose ObjectID falls in [first_oid, last_oid], using the indexed OID field"""
+    params = {
+        "where": f"({query}) AND {oid_field} BETWEEN {first_oid} AND {last_oid}",
+        "outFields": "*"
+    }
+    return query_features(session, rest_service_url, params, transport, options)
+
+def fetch_object_ids(session, rest_service_url, query):
+    """Return the ObjectID field name and the sorted ObjectIDs matching the query"""
+    params = {
+        "where": query,
+        "returnIdsOnly": True,
+        "f": "json"
+    }
+    response = session.get(rest_service_url, params=params)
+    response.raise_for_status()
+    data = response.json()
+    if "error" in data:
+        raise RuntimeError(f"returnIdsOnly query failed: {data['error'].get('message', data['error'])}")
+    return data["objectIdFieldName"], sorted(data.get("objectIds") or [])
+
+def get_max_record_count(session, rest_service_url):
+    # Same request as get_layer_info, so the second one is answered by the HTTP cache
+    response = session.get(rest_service_url.rsplit("/query", 1)[0], params={"f": "json"})
+    response.raise_for_status()
+    return response.json().get("maxRecordCount", 1000)
+
+def get_total_record_count(session, rest_service_url, query):
+    params = {
+        "where": query,
+        "returnCountOnly": True,
+        "f": "json"
+    }
+    response = session.get(rest_service_url, params=params)
+    response.raise_for_status()
+    return response.json().get("count", 0)
+
+def get_layer_info(session, rest_service_url):
+    """Layer metadata (f=json), or {} if it can't be fetched"""
+    layer_url = rest_service_url.rsplit("/query", 1)[0]
+    try:
+        response = session.get(layer_url, params={"f": "json"})
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"Failed to fetch layer metadata: {e}")
+        return {}
+
+# Without an edit date a layer can change without its count changing, so its cached pages only live
+# this long after they were fetched: long enough to resume a failed download, short enough that a
+# later rerun fetches fresh data
+UNVERSIONED_PAGE_TTL = 6 * 3600
+
+def get_last_edit(layer_info):
+    editing_info = layer_info.get("editingInfo", {})
+    return editing_info.get("dataLastEditDate", editing_info.get("lastEditDate"))
+
+def get_data_version(layer_info, total_count):
+    # Cached pages are only reused while the layer's last edit date and the query's count are unchanged
+    return f"{get_last_edit(layer_info)}:{total_count}"
+
+def get_page_max_age(layer_info):
+    """Seconds a cached page stays usable: unlimited while the data version tracks edits, else UNVERSIONED_PAGE_TTL"""
+    return None if get_last_edit(layer_info) is not None else UNVERSIONED_PAGE_TTL
+
+# "geojson" or "pbf"; pbf is only used when the layer lists it in supportedQueryFormats
+TRANSPORTS = ("geojson", "pbf")
+
+def resolve_transport(layer_info, transport):
+    if transport == "pbf":
+        from arcgisPbfDecoder import supports_pbf
+
+        if not supports_pbf(layer_info):
+            print("Service does not advertise PBF support, falling back to GeoJSON")
+            return "geojson"
+    return transport
+
+# Fetched pages are kept here so a failed download can be resumed
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".snb_page_cache")
+MAX_CACHE_BYTES = 2 * 1024 ** 3  # Oldest pages are evicted past this size
+
+class PageCache(DiskStore):
+    """On-disk cache of fetched pages, keyed by service, query, offset, page size and data version"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        super().__init__(cache_dir, max_bytes, ".json.gz")
+
+    def path(self, rest_service_url, query, offset, page_size, version):
+        return self.entry_path([rest_service_url, query, offset, page_size, version])
+
+    def get(self, *key, max_age=None):
+        """Cached features, or None; with max_age, pages fetched longer ago than that count as missing"""
+        entry = self.load(self.path(*key))
+        if entry is None:
+            return None
+        header, body = entry
+        if not isinstance(header, dict):  # A page cached before fetch times were stored
+            return None
+        # The fetch time is stored in the page because the mtime is refreshed on every use
+        if max_age is not None and time.time() - header["stored"] > max_age:
+            return None
+        return json.loads(body)
+
+    def put(self, features, *key):
+        self.save(self.path(*key), {"stored": time.time()}, json.dumps(features).encode("utf-8"))
+
+def escape_series(values):
+    """Convert a column to XML-escaped strings in one pass instead of per value"""
+    return (values.astype(object).where(values.notna(), "").astype(str)
+            .str.replace("&", "&amp;", regex=False)
+            .str.replace("<", "&lt;", regex=False)
+            .str.replace(">", "&gt;", regex=False)
+            .str.replace('"', "&quot;", regex=False))
+
+def _coordinate_levels(geom_type, coords, offsets):
+    """Normalise shapely ragged offsets to (ring -> coords, part -> rings, geometry -> parts)"""
+    import numpy as np
+    import shapely
+
+    offsets = [np.asarray(o) for o in offsets]
+    if geom_type in (shapely.GeometryType.POINT, shapely.GeometryType.MULTIPOINT):
+        offsets.insert(0, np.arange(len(coords) + 1))  # every point is a one-coordinate "ring"
+    if geom_type not in (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON):
+        offsets.insert(1, np.arange(len(offsets[0])))  # every point/line part is a single ring
+    if len(offsets) == 2:
+        offsets.append(np.arange(len(offsets[1])))  # single-part geometries
+    return offsets
+
+def geometry_kml(geoms):
+    """Return the KML geometry element for each shapely geometry ('' if unsupported)"""
+    import numpy as np
+    import shapely
+
+    out = np.full(len(geoms), "", dtype=object)
+    type_ids = shapely.get_type_id(geoms)
+    type_ids[shapely.is_empty(geoms)] = -1
+    # shapely type ids: 0 Point, 1 LineString, 3 Polygon, 4-6 their multipart versions
+    for tag, ids in (("Point", (0, 4)), ("LineString", (1, 5)), ("Polygon", (3, 6))):
+        idx = np.flatnonzero(np.isin(type_ids, ids))
+        if not len(idx):
+            continue
+        geom_type, coords, offsets = shapely.to_ragged_array(geoms[idx], include_z=False)
+        ring_off, part_off, geom_off = _coordinate_levels(geom_type, coords, offsets)
+
+        # Format every coordinate in bulk, then slice rings out of the flat list
+        pairs = np.char.add(np.char.add(coords[:, 0].astype(str), ","), coords[:, 1].astype(str)).tolist()
+        rings = [" ".join(pairs[a:b]) for a, b in zip(ring_off[:-1], ring_off[1:])]
+
+        parts = []
+        for a, b in zip(part_off[:-1], part_off[1:]):
+            if tag == "Polygon":
+                inner = "".join(f"<innerBoundaryIs><LinearRing><coordinates>{r}</coordinates></LinearRing></innerBoundaryIs>"
+                                for r in rings[a + 1:b])
+                parts.append(f"<Polygon><outerBoundaryIs><LinearRing><coordinates>{rings[a]}</coordinates>"
+                             f"</LinearRing></outerBoundaryIs>{inner}</Polygon>")
+            else:
+                parts.append(f"<{tag}><coordinates>{rings[a]}</coordinates></{tag}>")
+
+        for i, a, b in zip(idx, geom_off[:-1], geom_off[1:]):
+            if type_ids[i] >= 4:
+                out[i] = "<MultiGeometry>" + "".join(parts[a:b]) + "</MultiGeometry>"
+            else:
+                out[i] = parts[a]
+    return out
+
+class KMZWriter:
+    """Stream placemarks into a zipped KML one batch at a time"""
+
+    def __init__(self, path, name_field="Descript"):
+        self.path = path
+        self.name_field = name_field
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self.stream = self.zip.open("doc.kml", "w", force_zip64=True)
+        self.stream.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                          b'<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
+
+    def write(self, gdf):
+        import numpy as np
+        import pandas as pd
+
+        geoms = geometry_kml(np.asarray(gdf.geometry, dtype=object))
+        supported = geoms != ""
+        if not supported.all():
+            for geom_type, count in gdf.geometry[~supported].geom_type.fillna("None").value_counts().items():
+                print(f"Unsupported or empty geometry type: {geom_type} ({count} skipped)")
+        gdf = gdf[supported]
+        if gdf.empty:
+            return
+
+        if self.name_field in gdf.columns:
+            names = escape_series(gdf[self.name_field])
+        else:
+            names = pd.Series("", index=gdf.index)
+
+        extended = pd.Series("", index=gdf.index)
+        for column in gdf.columns.drop(gdf.geometry.name):
+            key = saxutils.escape(str(column), {'"': "&quot;"})
+            extended += f'<Data name="{key}"><value>' + escape_series(gdf[column]) + "</value></Data>"
+
+        placemarks = ("<Placemark><name>" + names + "</name><ExtendedData>" + extended
+                      + "</ExtendedData>" + pd.Series(geoms[supported], index=gdf.index) + "</Placemark>\n")
+        self.stream.write("".join(placemarks.tolist()).encode("utf-8"))
+
+    def close(self):
+        self.stream.write(b"</Document></kml>\n")
+        self.stream.close()
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Layer name used inside the on-disk GeoPackage when streaming to disk
+STORE_LAYER = "SNBPropertyData"
+
+def append_page(store_path, features, first):
+    """Append one page of GeoJSON features to the GeoPackage store"""
+    import geopandas as gpd
+
+    return write_store(store_path, gpd.GeoDataFrame.from_features(features, crs="EPSG:4326"), first)
+
+def write_store(store_path, gdf, first):
+    gdf.to_file(store_path, layer=STORE_LAYER, driver="GPKG", mode="w" if first else "a")
+    return len(gdf)
+
+def iter_store_chunks(store_path, count, chunk_size):
+    """Read the GeoPackage store back as GeoDataFrames of at most chunk_size rows"""
+    import geopandas as gpd
+
+    for start in range(0, count, chunk_size):
+        yield gpd.read_file(store_path, layer=STORE_LAYER, rows=slice(start, start + chunk_size))
+
+
+# "offset" pages with resultOffset; "objectid" requests contiguous OBJECTID BETWEEN ranges,
+# which stays fast on deep pages and reads from one snapshot of the layer's IDs
+PAGINATION_MODES = ("offset", "objectid")
+
+class PageFetcher:
+    """Download every page of one query, reading and filling the page cache when one is given"""
+
+    def __init__(self, session, query, rest_service_url, max_record_count, total_count,
+                 max_workers=MAX_WORKERS, cache=None, data_version=None, progress=None, pagination="offset",
+                 transport="geojson", geometry_options=None, cache_max_age=None):
+        self.session = session
         self.query = query
         self.rest_service_url = rest_service_url
         self.max_record_count = max_record_count
         self.total_count = total_count
+        self.max_workers = max_workers
+        self.cache = cache
+        self.data_version = data_version
+        self.cache_max_age = cache_max_age
+        self.progress = progress or (lambda percent: None)
+        self.pagination = pagination
+        self.transport = transport
+        self.geometry_options = geometry_options or {}
+        self.oid_field = None
 
-    def run(self):
+    def fetch(self, store_path=None):
+        """Return {"features": [...]}, or {"store": path, "count": n} when streaming to a GeoPackage"""
         all_features = []
+        stored = 0
+        if self.max_workers > 1:
+            pages = self.iter_pages_concurrent()
+        else:
+            pages = self.iter_pages_sequential()
+
+        for features in pages:
+            if store_path:
+                # Only the current page is held in memory
+                stored += append_page(store_path, features, first=stored == 0)
+            else:
+                all_features.extend(features)
+
+        if store_path:
+            return {"store": store_path, "count": stored}
+        return {"features": all_features}
+
+    def plan_pages(self):
+        """Every page to request, as resultOffset values or (first, last) ObjectID ranges"""
+        if self.pagination == "objectid":
+            self.oid_field, oids = fetch_object_ids(self.session, self.rest_service_url, self.query)
+            groups = (oids[i:i + self.max_record_count] for i in range(0, len(oids), self.max_record_count))
+            return [(group[0], group[-1]) for group in groups]
+        return list(range(0, self.total_count, self.max_record_count))
+
+    def get_page(self, page):
+        # Protobuf and generalized pages are cached separately from full-resolution GeoJSON ones
+        version = self.data_version if self.transport == "geojson" else f"{self.data_version}:{self.transport}"
+        if self.geometry_options:
+            version = f"{version}:{json.dumps(self.geometry_options, sort_keys=True)}"
+        key = (self.rest_service_url, self.query, page, self.max_record_count, version)
+        if self.cache:
+            features = self.cache.get(*key, max_age=self.cache_max_age)
+            if features is not None:
+                return features
+
+        if isinstance(page, tuple):
+            features = fetch_oid_range(self.session, self.rest_service_url, self.query, self.oid_field, *page,
+                                       transport=self.transport, options=self.geometry_options)
+        else:
+            features = fetch_page(self.session, self.rest_service_url, self.query, page, self.max_record_count,
+                                  transport=self.transport, options=self.geometry_options)
+        if self.cache and features:
+            self.cache.put(features, *key)
+        return features
+
+    def iter_pages_sequential(self):
+        if self.pagination == "objectid":
+            pages = self.plan_pages()
+            for number, page in enumerate(pages, 1):
+                yield self.get_page(page)
+                self.progress(int((number / len(pages)) * 100))
+            return
+
         offset = 0
 
         while True:
-            params = {
-                "where": self.query,
-                "outFields": "*",  # Fetch all attributes
-                "f": "geojson",
-                "resultOffset": offset,
-                "resultRecordCount": self.max_record_count
-            }
+            features = self.get_page(offset)
+
+            if not features:
+                break  # No more records to fetch
+
+            yield features
+            offset += self.max_record_count
+            progress_percentage = int((offset / self.total_count) * 100)
+            self.progress(min(progress_percentage, 100))
+
+    def iter_pages_concurrent(self):
+        # Pages are submitted and handed on in order with at most max_workers * 2 in flight, so the output
+        # matches a sequential fetch and only that many pages are held in memory at once
+        pages = self.plan_pages()
+        pending = deque()
+        submitted = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
             try:
-                response = requests.get(self.rest_service_url, params=params)
-                response.raise_for_status()
-                data = response.json()
-                features = data.get("features", [])
+                for done in range(1, len(pages) + 1):
+                    while submitted < len(pages) and len(pending) < self.max_workers * 2:
+                        pending.append(pool.submit(self.get_page, pages[submitted]))
+                        submitted += 1
+                    features = pending.popleft().result()
+                    self.progress(int((done / len(pages)) * 100))
+                    yield features
+                    del features  # Don't keep the page alive while waiting on the next one
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
 
-                if not features:
-                    break  # No more records to fetch
+def fetch_by_ids(session, rest_service_url, oid_field, oids, transport="geojson", options=None, batch_size=500):
+    """Fetch specific ObjectIDs, a batch at a time to keep the where clause short"""
+    features = []
+    for i in range(0, len(oids), batch_size):
+        ids = ",".join(str(oid) for oid in oids[i:i + batch_size])
+        features.extend(query_features(session, rest_service_url,
+                                       {"where": f"{oid_field} IN ({ids})", "outFields": "*"}, transport, options))
+    return features
 
-                all_features.extend(features)
-                offset += self.max_record_count
-                progress_percentage = int((offset / self.total_count) * 100)
-                self.progress.emit(min(progress_percentage, 100))
-            except Exception as e:
-                self.error_occurred.emit(str(e))
-                return
+# Edits newer than (last sync - overlap) are re-fetched, which absorbs clock skew with the server
+SYNC_OVERLAP_MS = 10 * 60 * 1000
 
-        self.data_fetched.emit({"features": all_features})
+class IncrementalSync:
+    """Keep a GeoPackage extract of one query current by fetching only what changed since the last sync
 
-class SNBDataDownloader(QtWidgets.QWidget):
-    def __init__(self):
-        super().__init__()
-        self.initUI()
-
-    def initUI(self):
-        self.setWindowTitle("Bulk SNB Property Assessment Data Downloader")
-        self.setGeometry(100, 100, 500, 300)
-        
-        layout = QtWidgets.QVBoxLayout()
-
-        self.queryLabel = QtWidgets.QLabel("Query Expression:")
-        self.queryInput = QTextEdit()
-        self.queryInput.setText("UPPER(Descript) SIMILAR TO '%(MULTI|APT|APART)%' AND UPPER(Descript) NOT LIKE '%(BAPT)%'")
-        self.queryInput.setFixedHeight(100)
-        layout.addWidget(self.queryLabel)
-        layout.addWidget(self.queryInput)
-
-        self.outputBtn = QtWidgets.QPushButton("Select Output Folder")
-        self.outputBtn.clicked.connect(self.select_output_folder)
-        layout.addWidget(self.outputBtn)
-
-        self.outputFolderLabel = QLabel("Output Folder: Not selected")
-        layout.addWidget(self.outputFolderLabel)
-        
-        self.progressBar = QProgressBar()
-        self.progressBar.setValue(0)
-        layout.addWidget(self.progressBar)
-
-        self.statusLabel = QLabel("Status: Ready")
-        layout.addWidget(self.statusLabel)
-
-        self.processBtn = QtWidgets.QPushButton("Download Data")
-        self.processBtn.clicked.connect(self.process_rest_data)
-        layout.addWidget(self.processBtn)
-
-        self.outputFolder = ""
-        self.rest_service_url = "https://geonb.snb.ca/arcgis/rest/services/GeoNB_SNB_Pan/MapServer/0/query"
-        
-        self.setLayout(layout)
-
-    def select_output_folder(self):
-        folder = QFileDialog.getExistingDirectory(self, "Select Output Folder")
-        if folder:
-            self.outputFolder = folder
-            self.outputFolderLabel.setText(f"Output Folder: {folder}")
-            print(f"Output folder selected: {folder}")
-
-    def get_max_record_count(self):
-        params = {"f": "json"}
-        try:
-            response = requests.get(self.rest_service_url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("maxRecordCount", 1000)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to fetch maxRecordCount: {e}")
-            return 1000
-
-    def get_total_record_count(self, query):
-        params = {
-            "where": query,
-            "returnCountOnly": True,
-            "f": "json"
-        }
+    The sync state (query, date field and last sync time) is kept in <store>.sync.json. Without a
+    matching state file the whole query is downloaded once through the given PageFetcher.
+    """
+
+    def __init__(self, fetcher, store_path, layer_info, date_field=None, chunk_size=None):
+        self.fetcher = fetcher
+        self.store_path = store_path
+        self.state_path = store_path + ".sync.json"
+        edit_fields = layer_info.get("editFieldsInfo") or {}
+        self.date_field = date_field or edit_fields.get("editDateField")
+        self.chunk_size = chunk_size or fetcher.max_record_count
+
+    def read_state(self):
         try:
-            response = requests.get(self.rest_service_url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("count", 0)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to fetch total record count: {e}")
-            return 0
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get("rest_service_url") != self.fetcher.rest_service_url or state.get("query") != self.fetcher.query
+                or state.get("date_field") != self.date_field or not os.path.exists(self.store_path)):
+            return None
+        return state
 
-    def process_rest_data(self):
-        self.processBtn.setEnabled(False)
-        self.outputBtn.setEnabled(False)
-        self.statusLabel.setText("Status: In Progress...")
+    def write_state(self, started_ms):
+        state = {"rest_service_url": self.fetcher.rest_service_url, "query": self.fetcher.query,
+                 "date_field": self.date_field, "last_sync": started_ms}
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
 
-        query = self.queryInput.toPlainText()
+    def run(self):
+        """Return {"store": path, "count": n} for the refreshed extract"""
+        if not self.date_field:
+            raise RuntimeError("Layer has no edit date field; choose a date field for incremental refresh")
 
-        if not query or not self.outputFolder:
-            QMessageBox.critical(self, "Error", "All fields must be filled out!")
-            self.processBtn.setEnabled(True)
-            self.outputBtn.setEnabled(True)
-            self.statusLabel.setText("Status: Ready")
-            return
+        started_ms = int(time.time() * 1000)
+        state = self.read_state()
+        if state is None:
+            print("No previous extract for this query, downloading everything")
+            geojson_data = self.fetcher.fetch(self.store_path)
+        else:
+            geojson_data = self.refresh(state["last_sync"] - SYNC_OVERLAP_MS)
+        self.write_state(started_ms)
+        return geojson_data
 
-        max_record_count = self.get_max_record_count()
-        total_count = self.get_total_record_count(query)
-        if total_count == 0:
-            QMessageBox.critical(self, "Error", "No records found for the given query!")
-            self.reset_ui()
-            return
+    def refresh(self, since_ms):
+        import geopandas as gpd
 
-        self.fetcher = DataFetcher(query, self.rest_service_url, max_record_count, total_count)
-        self.fetcher.progress.connect(self.progressBar.setValue)
-        self.fetcher.data_fetched.connect(self.process_fetched_data)
-        self.fetcher.error_occurred.connect(self.handle_error)
-        self.fetcher.start()
+        fetcher = self.fetcher
+        since = datetime.fromtimestamp(since_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        changed_query = f"({fetcher.query}) AND {self.date_field} > TIMESTAMP '{since}'"
 
-    def process_fetched_data(self, geojson_data):
-        if not geojson_data or not geojson_data["features"]:
-            QMessageBox.critical(self, "Error", "No data retrieved!")
-            self.reset_ui()
-            return
+        # Deletions (and features that no longer match) show up as IDs we have that the server doesn't
+        oid_field, server_ids = fetch_object_ids(fetcher.session, fetcher.rest_service_url, fetcher.query)
+        local = gpd.read_file(self.store_path, layer=STORE_LAYER, columns=[oid_field], ignore_geometry=True)
+        local_ids = set(local[oid_field].tolist())
+        server_ids = set(server_ids)
 
-        gdf = gpd.GeoDataFrame.from_features(geojson_data["features"])
+        changed_count = get_total_record_count(fetcher.session, fetcher.rest_service_url, changed_query)
+        changed = []
+        if changed_count:
+            changed = PageFetcher(fetcher.session, changed_query, fetcher.rest_service_url, fetcher.max_record_count,
+                                  changed_count, max_workers=fetcher.max_workers, progress=fetcher.progress,
+                                  transport=fetcher.transport,
+                                  geometry_options=fetcher.geometry_options).fetch()["features"]
+        changed_ids = {feature["properties"][oid_field] for feature in changed}
 
-        output_kmz = os.path.join(self.outputFolder, "SNBPropertyData.kmz")
-        output_xls = os.path.join(self.outputFolder, "SNBPropertyData.xlsx")
+        # Features that started matching the query without being edited are fetched by ID
+        missing = sorted(server_ids - local_ids - changed_ids)
+        if missing:
+            changed += fetch_by_ids(fetcher.session, fetcher.rest_service_url, oid_field, missing, fetcher.transport,
+                                    fetcher.geometry_options)
 
-        try:
-            # Create KML file using simplekml
-            kml = simplekml.Kml()
-            for _, row in gdf.iterrows():
-                geom = row.geometry
-                attrs = row.drop('geometry').to_dict()
-                if geom.geom_type == 'Point':
-                    pnt = kml.newpoint(name=row['Descript'], coords=[(geom.x, geom.y)])
-                    for key, value in attrs.items():
-                        pnt.extendeddata.newdata(name=key, value=str(sanitize(value)))
-                elif geom.geom_type == 'Polygon':
-                    pol = kml.newpolygon(name=row['Descript'])
-                    pol.outerboundaryis = [(x, y) for x, y in zip(*geom.exterior.xy)]
-                    for key, value in attrs.items():
-                        pol.extendeddata.newdata(name=key, value=str(sanitize(value)))
-                elif geom.geom_type == 'LineString':
-                    line = kml.newlinestring(name=row['Descript'])
-                    line.coords = [(x, y) for x, y in zip(*geom.xy)]
-                    for key, value in attrs.items():
-                        line.extendeddata.newdata(name=key, value=str(sanitize(value)))
+        deleted = local_ids - server_ids
+        print(f"Incremental refresh since {since} UTC: {len(changed)} changed or new, {len(deleted)} deleted")
+        drop = deleted | {feature["properties"][oid_field] for feature in changed}
+        return {"store": self.store_path, "count": self.merge(oid_field, len(local), drop, changed)}
+
+    def merge(self, oid_field, local_count, drop_ids, changed):
+        """Rewrite the store a chunk at a time without the dropped rows, then append the changes"""
+        tmp_path = self.store_path + ".tmp.gpkg"
+        count = 0
+        for gdf in iter_store_chunks(self.store_path, local_count, self.chunk_size):
+            keep = gdf[~gdf[oid_field].isin(drop_ids)]
+            if len(keep):
+                count += write_store(tmp_path, keep, first=count == 0)
+        for i in range(0, len(changed), self.chunk_size):
+            count += append_page(tmp_path, changed[i:i + self.chunk_size], first=count == 0)
+
+        if count:
+            os.replace(tmp_path, self.store_path)
+        else:
+            os.remove(self.store_path)
+        return count
+
+def iter_chunks(geojson_data, chunk_size):
+    """Yield the fetched data as GeoDataFrames, one store chunk at a time when streaming"""
+    if geojson_data.get("store"):
+        # Re-read the store lazily so only one chunk is in memory at a time
+        yield from iter_store_chunks(geojson_data["store"], geojson_data["count"], chunk_size)
+    else:
+        import geopandas as gpd
+
+        yield gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:4326")
+
+def write_kmz(geojson_data, path, chunk_size):
+    # Each chunk is serialised straight into the zipped KML stream
+    with KMZWriter(path) as kmz:
+        for gdf in iter_chunks(geojson_data, chunk_size):
+            kmz.write(gdf)
+
+# Excel's hard limit per worksheet, including the header row
+EXCEL_MAX_ROWS = 1048576
+
+def write_xlsx(geojson_data, path, chunk_size):
+    """Stream rows into a write-only workbook, starting a new sheet whenever Excel's row limit is hit"""
+    import pandas as pd
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_count = 0
+    rows = 0
+    for gdf in iter_chunks(geojson_data, chunk_size):
+        df = pd.DataFrame(gdf)
+        df[gdf.geometry.name] = gdf.geometry.to_wkt()
+        df = df.astype(object).where(df.notna(), None)
+        for row in df.itertuples(index=False, name=None):
+            if sheet is None or rows >= EXCEL_MAX_ROWS:
+                sheet_count += 1
+                sheet = workbook.create_sheet(STORE_LAYER if sheet_count == 1 else f"{STORE_LAYER}_{sheet_count}")
+                sheet.append([str(column) for column in df.columns])
+                rows = 1
+            sheet.append(row)
+            rows += 1
+
+    if sheet is None:
+        workbook.create_sheet(STORE_LAYER)
+    workbook.save(path)
+
+def write_csv(geojson_data, path, chunk_size):
+    # Geometry is written as WKT
+    first = True
+    for gdf in iter_chunks(geojson_data, chunk_size):
+        gdf.to_csv(path, mode="w" if first else "a", header=first, index=False, encoding="utf-8")
+        first = False
+
+def store_arrow_types(store_path):
+    """Arrow type of each attribute field of the GeoPackage store, from the field types it was created with"""
+    import numpy as np
+    import pyarrow as pa
+    import pyogrio
+
+    info = pyogrio.read_info(store_path, layer=STORE_LAYER)
+    return {name: pa.string() if dtype == "object" else pa.from_numpy_dtype(np.dtype(dtype))
+            for name, dtype in zip(info["fields"], info["dtypes"])}
+
+def write_parquet(geojson_data, path, chunk_size):
+    """Write GeoParquet (WKB geometry plus "geo" metadata) one row group per chunk"""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for gdf in iter_chunks(geojson_data, chunk_size):
+            geometry = gdf.geometry.name
+            df = pd.DataFrame(gdf)
+            df[geometry] = gdf.geometry.to_wkb()
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                if geojson_data.get("store"):
+                    # A column that is empty throughout the first chunk is inferred as null,
+                    # which later chunks can't be cast to, so take its type from the store
+                    types = store_arrow_types(geojson_data["store"])
+                    for i, field in enumerate(schema):
+                        if pa.types.is_null(field.type) and field.name in types:
+                            schema = schema.set(i, field.with_type(types[field.name]))
+                # No "crs" key means OGC:CRS84, which is what the service returns as GeoJSON
+                geo = {"version": "1.0.0", "primary_column": geometry,
+                       "columns": {geometry: {"encoding": "WKB", "geometry_types": []}}}
+                schema = schema.with_metadata({**(schema.metadata or {}),
+                                               b"geo": json.dumps(geo).encode("utf-8")})
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def write_geojson(geojson_data, path, chunk_size):
+    # Needs no third-party libraries unless the pages were streamed to a GeoPackage
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        first = True
+        if geojson_data.get("store"):
+            pages = (json.loads(gdf.to_json())["features"] for gdf in iter_chunks(geojson_data, chunk_size))
+        else:
+            pages = [geojson_data["features"]]
+        for features in pages:
+            for feature in features:
+                f.write(("" if first else ",\n") + json.dumps(feature))
+                first = False
+        f.write("\n]}\n")
+
+# Output file extension -> writer
+OUTPUT_WRITERS = {
+    ".kmz": write_kmz,
+    ".xlsx": write_xlsx,
+    ".csv": write_csv,
+    ".parquet": write_parquet,
+    ".geojson": write_geojson,
+    ".json": write_geojson,
+}
+
+def write_outputs(geojson_data, targets, chunk_size):
+    """Write every output at the same time; returns {target: exception} for the ones that failed"""
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = {target: pool.submit(OUTPUT_WRITERS[os.path.splitext(target)[1].lower()],
+                                       geojson_data, target, chunk_size) for target in targets}
+    return {target: future.exception() for target, future in futures.items() if future.exception()}
+
+def write_metadata(path, rest_service_url, query, fetcher, records, transferred, elapsed):
+    """Record how an extract was downloaded, including any geometry generalization, next to its outputs"""
+    options = dict(fetcher.geometry_options)
+    if "quantizationParameters" in options:
+        options["quantizationParameters"] = json.loads(options["quantizationParameters"])
+    metadata = {
+        "service": rest_service_url,
+        "query": query,
+        "downloaded": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "records": records,
+        "transport": fetcher.transport,
+        "pagination": fetcher.pagination,
+        "geometry_options": options or "full resolution",
+        "bytes_transferred": transferred,
+        "elapsed_seconds": round(elapsed, 2),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+
+def count_vertices(features):
+    """Total coordinate positions in a list of GeoJSON features"""
+    def count(coords):
+        if not coords:
+            return 0
+        if isinstance(coords[0], (int, float)):
+            return 1
+        return sum(count(c) for c in coords)
+    return sum(count((feature.get("geometry") or {}).get("coordinates")) for feature in features)
+
+def run_benchmark(jobs, rest_service_url=REST_SERVICE_URL, max_workers=MAX_WORKERS, pagination="offset",
+                  transport="geojson", options=None):
+    """Download each query at full resolution and with the geometry options, and compare bytes, time and vertices"""
+    with make_session(max_workers, http_cache=False) as session:
+        max_record_count = get_max_record_count(session, rest_service_url)
+        transport = resolve_transport(get_layer_info(session, rest_service_url), transport)
+        for query, _ in jobs:
+            total_count = get_total_record_count(session, rest_service_url, query)
+            print(f"{query} ({total_count} records, {transport})")
+            results = []
+            for label, geometry in (("full resolution", {}), ("generalized", options or {})):
+                # A fresh session per run so connection reuse doesn't favour the second one
+                with make_session(max_workers, http_cache=False) as run_session:
+                    counter = count_transfer(run_session)
+                    started = time.perf_counter()
+                    features = PageFetcher(run_session, query, rest_service_url, max_record_count, total_count,
+                                           max_workers=max_workers, pagination=pagination, transport=transport,
+                                           geometry_options=geometry).fetch()["features"]
+                    results.append((counter.bytes, time.perf_counter() - started, count_vertices(features)))
+                print(f"  {label:<16} {results[-1][0] / 1024 ** 2:10.2f} MB {results[-1][1]:8.2f} s"
+                      f" {results[-1][2]:12,} vertices")
+            (base_bytes, base_time, base_vertices), (opt_bytes, opt_time, opt_vertices) = results
+            print(f"  saved            {(base_bytes - opt_bytes) / 1024 ** 2:10.2f} MB {base_time - opt_time:8.2f} s"
+                  f" {base_vertices - opt_vertices:12,} vertices"
+                  f" ({100 * (1 - opt_bytes / max(base_bytes, 1)):.0f}% fewer bytes,"
+                  f" {100 * (1 - opt_vertices / max(base_vertices, 1)):.0f}% fewer vertices)")
+    return 0
+
+def run_batch(jobs, rest_service_url=REST_SERVICE_URL, stream=False, use_cache=True, max_workers=MAX_WORKERS,
+              pagination="offset", transport="geojson", incremental=False, date_field=None, options=None):
+    """Run each (where clause, [output paths]) job back to back over one shared session"""
+    cache = PageCache() if use_cache else None
+    failed = 0
+
+    with make_session(max_workers, http_cache=use_cache) as session:
+        counter = count_transfer(session)
+        # The layer's page size is the same for every job so it is only looked up once
+        max_record_count = get_max_record_count(session, rest_service_url)
+        print(f"maxRecordCount: {max_record_count}")
+        layer_info = get_layer_info(session, rest_service_url)
+        transport = resolve_transport(layer_info, transport)
+
+        for number, (query, targets) in enumerate(jobs, 1):
+            print(f"[{number}/{len(jobs)}] {query}")
+            try:
+                total_count = get_total_record_count(session, rest_service_url, query)
+                if total_count == 0:
+                    print("  No records found for the given query!")
+                    continue
+
+                for target in targets:
+                    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+                store_path = os.path.splitext(targets[0])[0] + ".gpkg" if stream or incremental else None
+                transferred, started = counter.bytes, time.perf_counter()
+                fetcher = PageFetcher(session, query, rest_service_url, max_record_count, total_count,
+                                      max_workers=max_workers, cache=cache,
+                                      data_version=get_data_version(layer_info, total_count),
+                                      cache_max_age=get_page_max_age(layer_info),
+                                      progress=lambda percent: print(f"\r  {percent}% of {total_count} records",
+                                                                     end="", flush=True),
+                                      pagination=pagination, transport=transport, geometry_options=options)
+                if incremental:
+                    geojson_data = IncrementalSync(fetcher, store_path, layer_info, date_field).run()
                 else:
-                    print(f"Unsupported geometry type: {geom.geom_type}")
-            kml.save(output_kmz)
-            print(f"KMZ file saved to: {output_kmz}")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to save KMZ file: {e}")
-            self.reset_ui()
-            return
+                    geojson_data = fetcher.fetch(store_path)
+                print()
+                write_metadata(os.path.splitext(targets[0])[0] + ".metadata.json", rest_service_url, query, fetcher,
+                               geojson_data.get("count", len(geojson_data.get("features", []))),
+                               counter.bytes - transferred, time.perf_counter() - started)
 
-        try:
-            gdf.to_excel(output_xls, index=False)
-            print(f"Excel file saved to: {output_xls}")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to save Excel file: {e}")
-            self.reset_ui()
-            return
+                errors = write_outputs(geojson_data, targets, max_record_count)
+                for target in targets:
+                    if target in errors:
+                        print(f"  Failed to save {target}: {errors[target]}")
+                    else:
+                        print(f"  Saved: {target}")
+                if errors:
+                    failed += 1
+            except Exception as e:
+                print(f"\n  Failed: {e}")
+                failed += 1
 
-        self.progressBar.setValue(100)
-        QMessageBox.information(self, "Success", "Processing complete!")
-        self.close()
+        http_cache = getattr(session.get_adapter(rest_service_url), "cache", None)
+        if http_cache is not None:
+            print(http_cache.summary())
 
-    def handle_error(self, error_message):
-        QMessageBox.critical(self, "Error", f"{error_message}")
-        self.reset_ui()
+    return 1 if failed else 0
 
-    def reset_ui(self):
-        self.processBtn.setEnabled(True)
-        self.outputBtn.setEnabled(True)
-        self.statusLabel.setText("Status: Ready")
+def run_gui():
+    from PyQt6 import QtWidgets
+    from PyQt6.QtWidgets import QFileDialog, QMessageBox, QLabel, QProgressBar, QTextEdit, QCheckBox, QComboBox, QLineEdit
+    from PyQt6.QtCore import QThread, pyqtSignal
+
+    class DataFetcher(QThread):
+        progress = pyqtSignal(int)
+        data_fetched = pyqtSignal(dict)
+        error_occurred = pyqtSignal(str)
+
+        def __init__(self, query, rest_service_url, max_record_count, total_count, max_workers=MAX_WORKERS,
+                     store_path=None, cache=None, data_version=None, pagination="offset", transport="geojson",
+                     layer_info=None, incremental=False, date_field=None, geometry_options=None, metadata_path=None):
+            super().__init__()
+            self.query = query
+            self.rest_service_url = rest_service_url
+            self.max_record_count = max_record_count
+            self.total_count = total_count
+            self.max_workers = max_workers
+            self.store_path = store_path
+            self.cache = cache
+            self.data_version = data_version
+            self.pagination = pagination
+            self.transport = transport
+            self.layer_info = layer_info or {}
+            self.incremental = incremental
+            self.date_field = date_field
+            self.geometry_options = geometry_options
+            self.metadata_path = metadata_path
+
+        def run(self):
+            try:
+                with make_session(self.max_workers) as session:
+                    counter = count_transfer(session)
+                    started = time.perf_counter()
+                    fetcher = PageFetcher(session, self.query, self.rest_service_url, self.max_record_count,
+                                          self.total_count, max_workers=self.max_workers, cache=self.cache,
+                                          data_version=self.data_version, progress=self.progress.emit,
+                                          cache_max_age=get_page_max_age(self.layer_info),
+                                          pagination=self.pagination, transport=self.transport,
+                                          geometry_options=self.geometry_options)
+                    if self.incremental:
+                        geojson_data = IncrementalSync(fetcher, self.store_path, self.layer_info, self.date_field).run()
+                    else:
+                        geojson_data = fetcher.fetch(self.store_path)
+                if self.metadata_path:
+                    write_metadata(self.metadata_path, self.rest_service_url, self.query, fetcher,
+                                   geojson_data.get("count", len(geojson_data.get("features", []))),
+                                   counter.bytes, time.perf_counter() - started)
+            except Exception as e:
+                message = str(e)
+                if self.cache:
+                    message += "\n\nPages fetched so far are cached. Run the same query again to resume."
+                self.error_occurred.emit(message)
+                return
+
+            self.data_fetched.emit(geojson_data)
+
+    class SNBDataDownloader(QtWidgets.QWidget):
+        def __init__(self):
+            super().__init__()
+            self.initUI()
+
+        def initUI(self):
+            self.setWindowTitle("Bulk SNB Property Assessment Data Downloader")
+            self.setGeometry(100, 100, 500, 300)
+            
+            layout = QtWidgets.QVBoxLayout()
+
+            self.queryLabel = QtWidgets.QLabel("Query Expression:")
+            self.queryInput = QTextEdit()
+            self.queryInput.setText("UPPER(Descript) SIMILAR TO '%(MULTI|APT|APART)%' AND UPPER(Descript) NOT LIKE '%(BAPT)%'")
+            self.queryInput.setFixedHeight(100)
+            layout.addWidget(self.queryLabel)
+            layout.addWidget(self.queryInput)
+
+            self.outputBtn = QtWidgets.QPushButton("Select Output Folder")
+            self.outputBtn.clicked.connect(self.select_output_folder)
+            layout.addWidget(self.outputBtn)
+
+            self.outputFolderLabel = QLabel("Output Folder: Not selected")
+            layout.addWidget(self.outputFolderLabel)
+            
+            self.tableFormatLabel = QLabel("Table Format:")
+            self.tableFormat = QComboBox()
+            self.tableFormat.addItem("Excel (.xlsx)", ".xlsx")
+            self.tableFormat.addItem("GeoParquet (.parquet)", ".parquet")
+            self.tableFormat.addItem("CSV (.csv)", ".csv")
+            layout.addWidget(self.tableFormatLabel)
+            layout.addWidget(self.tableFormat)
+
+            self.paginationLabel = QLabel("Pagination:")
+            self.pagination = QComboBox()
+            self.pagination.addItem("Result offset", "offset")
+            self.pagination.addItem("ObjectID ranges (faster on deep pages, consistent snapshot)", "objectid")
+            layout.addWidget(self.paginationLabel)
+            layout.addWidget(self.pagination)
+
+            self.pbfCheck = QCheckBox("Use protobuf (f=pbf) responses when the service supports them")
+            layout.addWidget(self.pbfCheck)
+
+            self.generalizeLabel = QLabel("Generalize geometry to (degrees, blank = full resolution):")
+            self.generalizeInput = QLineEdit()
+            self.generalizeInput.setPlaceholderText("e.g. 0.000005 (about 0.5 m)")
+            layout.addWidget(self.generalizeLabel)
+            layout.addWidget(self.generalizeInput)
+
+            self.streamCheck = QCheckBox("Stream to disk (low memory, for large queries)")
+            layout.addWidget(self.streamCheck)
+
+            self.incrementalCheck = QCheckBox("Incremental refresh (only fetch edits since the last run into this folder)")
+            self.dateFieldInput = QLineEdit()
+            self.dateFieldInput.setPlaceholderText("Date field (blank = layer's edit date field)")
+            self.dateFieldInput.setEnabled(False)
+            self.incrementalCheck.toggled.connect(self.dateFieldInput.setEnabled)
+            incrementalLayout = QtWidgets.QHBoxLayout()
+            incrementalLayout.addWidget(self.incrementalCheck)
+            incrementalLayout.addWidget(self.dateFieldInput)
+            layout.addLayout(incrementalLayout)
+
+            self.progressBar = QProgressBar()
+            self.progressBar.setValue(0)
+            layout.addWidget(self.progressBar)
+
+            self.statusLabel = QLabel("Status: Ready")
+            layout.addWidget(self.statusLabel)
+
+            self.processBtn = QtWidgets.QPushButton("Download Data")
+            self.processBtn.clicked.connect(self.process_rest_data)
+            layout.addWidget(self.processBtn)
+
+            self.clearCacheBtn = QtWidgets.QPushButton("Clear Page Cache")
+            self.clearCacheBtn.clicked.connect(self.clear_cache)
+            layout.addWidget(self.clearCacheBtn)
+
+            self.outputFolder = ""
+            self.rest_service_url = REST_SERVICE_URL
+            self.session = make_session()
+            self.cache = PageCache()
+            
+            self.setLayout(layout)
+
+        def select_output_folder(self):
+            folder = QFileDialog.getExistingDirectory(self, "Select Output Folder")
+            if folder:
+                self.outputFolder = folder
+                self.outputFolderLabel.setText(f"Output Folder: {folder}")
+                print(f"Output folder selected: {folder}")
+
+        def get_max_record_count(self):
+            try:
+                return get_max_record_count(self.session, self.rest_service_url)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Failed to fetch maxRecordCount: {e}")
+                return 1000
+
+        def clear_cache(self):
+            self.cache.clear()
+            http_cache = getattr(self.session.get_adapter(self.rest_service_url), "cache", None)
+            if http_cache is not None:
+                http_cache.clear()
+            QMessageBox.information(self, "Cache Cleared", "Cached pages and metadata have been removed.")
+
+        def get_total_record_count(self, query):
+            try:
+                return get_total_record_count(self.session, self.rest_service_url, query)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Failed to fetch total record count: {e}")
+                return 0
+
+        def process_rest_data(self):
+            self.processBtn.setEnabled(False)
+            self.outputBtn.setEnabled(False)
+            self.statusLabel.setText("Status: In Progress...")
+
+            query = self.queryInput.toPlainText()
+
+            if not query or not self.outputFolder:
+                QMessageBox.critical(self, "Error", "All fields must be filled out!")
+                self.processBtn.setEnabled(True)
+                self.outputBtn.setEnabled(True)
+                self.statusLabel.setText("Status: Ready")
+                return
+
+            max_record_count = self.get_max_record_count()
+            total_count = self.get_total_record_count(query)
+            if total_count == 0:
+                QMessageBox.critical(self, "Error", "No records found for the given query!")
+                self.reset_ui()
+                return
+
+            self.chunk_size = max_record_count
+            layer_info = get_layer_info(self.session, self.rest_service_url)
+            transport = "pbf" if self.pbfCheck.isChecked() else "geojson"
+            try:
+                offset = float(self.generalizeInput.text()) if self.generalizeInput.text().strip() else None
+            except ValueError:
+                QMessageBox.critical(self, "Error", "Generalization tolerance must be a number!")
+                self.reset_ui()
+                return
+            date_field = self.dateFieldInput.text().strip() or None
+            if self.incrementalCheck.isChecked() and not (date_field or (layer_info.get("editFieldsInfo") or {}).get("editDateField")):
+                date_fields = [f["name"] for f in layer_info.get("fields", []) if f.get("type") == "esriFieldTypeDate"]
+                QMessageBox.critical(self, "Error", "This layer has no edit date field. Enter a date field for incremental refresh"
+                                     + (f" ({', '.join(date_fields)})." if date_fields else ", or untick it."))
+                self.reset_ui()
+                return
+            store_path = None
+            if self.streamCheck.isChecked() or self.incrementalCheck.isChecked():
+                store_path = os.path.join(self.outputFolder, "SNBPropertyData.gpkg")
+
+            self.fetcher = DataFetcher(query, self.rest_service_url, max_record_count, total_count,
+                                       store_path=store_path, cache=self.cache,
+                                       data_version=get_data_version(layer_info, total_count),
+                                       pagination=self.pagination.currentData(),
+                                       transport=resolve_transport(layer_info, transport),
+                                       layer_info=layer_info, incremental=self.incrementalCheck.isChecked(),
+                                       date_field=date_field,
+                                       geometry_options=geometry_options(max_allowable_offset=offset),
+                                       metadata_path=os.path.join(self.outputFolder, "SNBPropertyData.metadata.json"))
+            self.fetcher.progress.connect(self.progressBar.setValue)
+            self.fetcher.data_fetched.connect(self.process_fetched_data)
+            self.fetcher.error_occurred.connect(self.handle_error)
+            self.fetcher.start()
+
+        def process_fetched_data(self, geojson_data):
+            if not geojson_data or not (geojson_data.get("features") or geojson_data.get("count")):
+                QMessageBox.critical(self, "Error", "No data retrieved!")
+                self.reset_ui()
+                return
+
+            output_kmz = os.path.join(self.outputFolder, "SNBPropertyData.kmz")
+            output_table = os.path.join(self.outputFolder, "SNBPropertyData" + self.tableFormat.currentData())
+
+            # The KMZ and the table are written at the same time
+            errors = write_outputs(geojson_data, [output_kmz, output_table], self.chunk_size)
+            for path in (output_kmz, output_table):
+                if path not in errors:
+                    print(f"File saved to: {path}")
+            if errors:
+                QMessageBox.critical(self, "Error", "\n".join(f"Failed to save {os.path.basename(path)}: {e}"
+                                                              for path, e in errors.items()))
+                self.reset_ui()
+                return
+
+            self.progressBar.setValue(100)
+            QMessageBox.information(self, "Success", "Processing complete!")
+            self.close()
+
+        def handle_error(self, error_message):
+            QMessageBox.critical(self, "Error", f"{error_message}")
+            self.reset_ui()
+
+        def reset_ui(self):
+            self.processBtn.setEnabled(True)
+            self.outputBtn.setEnabled(True)
+            self.statusLabel.setText("Status: Ready")
 
-if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
     window = SNBDataDownloader()
     window.show()
-    sys.exit(app.exec())
+    return app.exec()
 
+def read_jobs_file(path):
+    """Each CSV row is a where clause followed by one or more output paths"""
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(row[0], row[1:]) for row in csv.reader(f) if row and row[0].strip()]
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bulk download SNB property assessment data. Run without arguments to open the GUI.")
+    parser.add_argument("--job", nargs="+", action="append", default=[], metavar=("WHERE", "OUTPUT"),
+                        help="where clause followed by output paths (.kmz, .xlsx, .csv, .parquet, .geojson); repeatable")
+    parser.add_argument("--jobs-file", help="CSV file with a where clause and its output paths on each row")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream pages to a GeoPackage next to the first output instead of memory")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep a GeoPackage next to the first output and only fetch changes on later runs")
+    parser.add_argument("--date-field", help="last-edited date field for --incremental (default: the layer's "
+                                             "edit tracking field)")
+    parser.add_argument("--max-allowable-offset", type=float,
+                        help="let the server generalize geometry to this tolerance (degrees)")
+    parser.add_argument("--geometry-precision", type=int, help="decimal places kept in coordinates")
+    parser.add_argument("--quantization-tolerance", type=float,
+                        help="snap coordinates to a grid of this size (degrees) on the server")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare bytes, time and vertices of a full-resolution download against the geometry options "
+                             "for each job, without writing outputs")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the page cache")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="concurrent page requests")
+    parser.add_argument("--pagination", choices=PAGINATION_MODES, default="offset",
+                        help="page with resultOffset or with contiguous ObjectID ranges")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="geojson",
+                        help="response format; pbf falls back to geojson if the service doesn't support it")
+    parser.add_argument("--url", default=REST_SERVICE_URL, help="layer query endpoint")
+    args = parser.parse_args(argv)
 
+    jobs = [(job[0], job[1:]) for job in args.job]
+    if args.jobs_file:
+        jobs += read_jobs_file(args.jobs_file)
+    if not jobs:
+        return run_gui()
+
+    for query, targets in jobs:
+        if not targets:
+            parser.error(f"no output path given for: {query}")
+        for target in targets:
+            if os.path.splitext(target)[1].lower() not in OUTPUT_WRITERS:
+                parser.error(f"unsupported output format: {target}")
+
+    options = geometry_options(args.max_allowable_offset, args.geometry_precision, args.quantization_tolerance)
+    if args.benchmark:
+        return run_benchmark(jobs, args.url, max_workers=args.workers, pagination=args.pagination,
+                             transport=args.transport, options=options)
+
+    return run_batch(jobs, args.url, stream=args.stream, use_cache=not args.no_cache, max_workers=args.workers,
+                     pagination=args.pagination, transport=args.transport, incremental=args.incremental,
+                     date_field=args.date_field, options=options)
+
+if __name__ == "__main__":
+    sys.exit(main())
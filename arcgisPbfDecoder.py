@@ -0,0 +1,347 @@
+"""Decode ArcGIS REST query responses requested with f=pbf (esriPBuffer.FeatureCollectionPBuffer).
+
+Pure Python, no protobuf package needed. Nested messages are read as offsets into the one response
+buffer, coordinates are dequantized per response into array('d') buffers and attributes are kept as
+one list per field. Results can be turned into GeoJSON features or Esri JSON.
+"""
+import struct
+from array import array
+
+GEOMETRY_TYPES = {0: "esriGeometryPoint", 1: "esriGeometryMultipoint", 2: "esriGeometryPolyline",
+                  3: "esriGeometryPolygon", 4: "esriGeometryMultiPatch", 127: "esriGeometryNull"}
+
+FIELD_TYPES = ["esriFieldTypeSmallInteger", "esriFieldTypeInteger", "esriFieldTypeSingle",
+               "esriFieldTypeDouble", "esriFieldTypeString", "esriFieldTypeDate", "esriFieldTypeOID",
+               "esriFieldTypeGeometry", "esriFieldTypeBlob", "esriFieldTypeRaster", "esriFieldTypeGUID",
+               "esriFieldTypeGlobalID", "esriFieldTypeXML"]
+
+_DOUBLE = struct.Struct("<d")
+_FLOAT = struct.Struct("<f")
+
+
+def supports_pbf(layer_info):
+    """True if the layer's metadata (f=json) advertises PBF in supportedQueryFormats"""
+    formats = layer_info.get("supportedQueryFormats") or ""
+    return "PBF" in [f.strip().upper() for f in formats.split(",")]
+
+
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _fields(buf, start, end):
+    """Yield (field number, value) for a message; length-delimited values are (start, end) offsets"""
+    pos = start
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire == 1:
+            value = _DOUBLE.unpack_from(buf, pos)[0]
+            pos += 8
+        elif wire == 5:
+            value = _FLOAT.unpack_from(buf, pos)[0]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire))
+        yield key >> 3, value
+
+
+def _packed(buf, span):
+    values = []
+    pos, end = span
+    while pos < end:
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _string(buf, span):
+    return bytes(buf[span[0]:span[1]]).decode("utf-8")
+
+
+def _value(buf, span):
+    """Decode one attribute Value message; an empty message is a null"""
+    for field, value in _fields(buf, span[0], span[1]):
+        if field == 1:
+            return _string(buf, value)
+        if field in (2, 3, 5, 7):
+            return value
+        if field in (4, 8):
+            return _zigzag(value)
+        if field == 6:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if field == 9:
+            return bool(value)
+    return None
+
+
+class FeatureResult(object):
+    """Decoded featureResult: one list per attribute field plus flat dequantized coordinates"""
+
+    def __init__(self):
+        self.object_id_field = None
+        self.geometry_type = "esriGeometryNull"
+        self.spatial_reference = {}
+        self.exceeded_transfer_limit = False
+        self.has_z = False
+        self.has_m = False
+        self.fields = []
+        self.columns = {}
+        self.coords = array("d")  # x, y[, z][, m] for every vertex of every feature
+        self.feature_offsets = [0]  # vertex index where each feature starts
+        self.part_lengths = []  # vertex count of each part, per feature (None for no geometry)
+
+    def __len__(self):
+        return len(self.part_lengths)
+
+    @property
+    def dims(self):
+        return 2 + self.has_z + self.has_m
+
+    def parts(self, i):
+        """Coordinate lists of each part of feature i, or None when it has no geometry"""
+        lengths = self.part_lengths[i]
+        if lengths is None:
+            return None
+        dims = self.dims
+        parts = []
+        pos = self.feature_offsets[i] * dims
+        for length in lengths:
+            flat = self.coords[pos:pos + length * dims]
+            parts.append([list(flat[j:j + dims]) for j in range(0, len(flat), dims)])
+            pos += length * dims
+        return parts
+
+    def attributes(self, i):
+        return dict((name, column[i]) for name, column in self.columns.items())
+
+
+def _transform(buf, span):
+    origin, scale, translate = 0, [1.0, 1.0, 1.0, 1.0], [0.0, 0.0, 0.0, 0.0]
+    for field, value in _fields(buf, span[0], span[1]):
+        if field == 1:
+            origin = value
+        elif field in (2, 3):
+            target = scale if field == 2 else translate
+            for index, number in _fields(buf, value[0], value[1]):
+                target[index - 1] = number
+    # Scale and Translate are stored as x, y, m, z
+    return origin, scale, translate
+
+
+def _feature_result(buf, start, end):
+    result = FeatureResult()
+    transform = None
+    raw_geometries = []
+    raw_attributes = []
+    for field, value in _fields(buf, start, end):
+        if field == 1:
+            result.object_id_field = _string(buf, value)
+        elif field == 7:
+            result.geometry_type = GEOMETRY_TYPES.get(value, "esriGeometryNull")
+        elif field == 8:
+            for key, item in _fields(buf, value[0], value[1]):
+                if key == 1:
+                    result.spatial_reference["wkid"] = item
+                elif key == 2:
+                    result.spatial_reference["latestWkid"] = item
+                elif key == 5:
+                    result.spatial_reference["wkt"] = _string(buf, item)
+        elif field == 9:
+            result.exceeded_transfer_limit = bool(value)
+        elif field == 10:
+            result.has_z = bool(value)
+        elif field == 11:
+            result.has_m = bool(value)
+        elif field == 12:
+            transform = _transform(buf, value)
+        elif field == 13:
+            info = {"name": None, "type": None, "alias": None}
+            for key, item in _fields(buf, value[0], value[1]):
+                if key == 1:
+                    info["name"] = _string(buf, item)
+                elif key == 2:
+                    info["type"] = FIELD_TYPES[item] if item < len(FIELD_TYPES) else item
+                elif key == 3:
+                    info["alias"] = _string(buf, item)
+            result.fields.append(info)
+        elif field == 15:
+            attributes, geometry = [], None
+            for key, item in _fields(buf, value[0], value[1]):
+                if key == 1:
+                    attributes.append(item)
+                elif key == 2:
+                    geometry = item
+            raw_attributes.append(attributes)
+            raw_geometries.append(geometry)
+
+    # Attributes arrive in field order; build one column per field
+    names = [f["name"] for f in result.fields]
+    columns = [[] for _ in names]
+    for attributes in raw_attributes:
+        for index, column in enumerate(columns):
+            column.append(_value(buf, attributes[index]) if index < len(attributes) else None)
+    result.columns = dict(zip(names, columns))
+
+    _dequantize(buf, result, raw_geometries, transform)
+    return result
+
+
+def _dequantize(buf, result, raw_geometries, transform):
+    """Undo the per-geometry delta encoding and quantization into result.coords"""
+    dims = result.dims
+    origin, scale, translate = transform or (0, [1.0, 1.0, 1.0, 1.0], [0.0, 0.0, 0.0, 0.0])
+    # Coordinates are ordered x, y, z, m; the transform stores x, y, m, z
+    scales = [scale[0], -scale[1] if origin == 0 else scale[1]]
+    offsets = [translate[0], translate[1]]
+    if result.has_z:
+        scales.append(scale[3])
+        offsets.append(translate[3])
+    if result.has_m:
+        scales.append(scale[2])
+        offsets.append(translate[2])
+
+    quantized = []
+    vertex_count = 0
+    for span in raw_geometries:
+        if span is None:
+            result.part_lengths.append(None)
+            result.feature_offsets.append(vertex_count)
+            continue
+        lengths, deltas = [], []
+        for key, item in _fields(buf, span[0], span[1]):
+            if key == 2:
+                lengths = _packed(buf, item)
+            elif key == 3:
+                deltas = [_zigzag(n) for n in _packed(buf, item)]
+        # Deltas run on through every part of the geometry
+        running = [0] * dims
+        for i in range(0, len(deltas), dims):
+            for d in range(dims):
+                running[d] += deltas[i + d]
+            quantized.extend(running)
+        count = len(deltas) // dims
+        result.part_lengths.append(lengths or [count])
+        vertex_count += count
+        result.feature_offsets.append(vertex_count)
+
+    # One pass over every coordinate of the response
+    result.coords = array("d", [q * scales[i % dims] + offsets[i % dims] for i, q in enumerate(quantized)])
+
+
+def decode(content):
+    """Decode a f=pbf query response; returns a FeatureResult, {"count": n} or {"objectIds": [...]}"""
+    buf = memoryview(content)
+    if not isinstance(buf[0], int):  # Python 2 memoryviews index as bytes
+        buf = bytearray(content)
+    for field, value in _fields(buf, 0, len(buf)):
+        if field != 2:
+            continue
+        for kind, span in _fields(buf, value[0], value[1]):
+            if kind == 1:
+                return _feature_result(buf, span[0], span[1])
+            if kind == 2:
+                for key, count in _fields(buf, span[0], span[1]):
+                    if key == 1:
+                        return {"count": count}
+                return {"count": 0}
+            if kind == 3:
+                ids = {"objectIdFieldName": None, "objectIds": []}
+                for key, item in _fields(buf, span[0], span[1]):
+                    if key == 1:
+                        ids["objectIdFieldName"] = _string(buf, item)
+                    elif key == 3:
+                        ids["objectIds"] = _packed(buf, item)
+                return ids
+    return FeatureResult()
+
+
+def _ring_is_clockwise(ring):
+    total = 0.0
+    for (x1, y1), (x2, y2) in zip([p[:2] for p in ring], [p[:2] for p in ring[1:]]):
+        total += (x2 - x1) * (y2 + y1)
+    return total > 0
+
+
+def _geojson_geometry(geometry_type, parts, dims):
+    if parts is None:
+        return None
+    parts = [[p[:dims] for p in part] for part in parts]
+    if geometry_type == "esriGeometryPoint":
+        return {"type": "Point", "coordinates": parts[0][0]}
+    if geometry_type == "esriGeometryMultipoint":
+        return {"type": "MultiPoint", "coordinates": [p for part in parts for p in part]}
+    if geometry_type == "esriGeometryPolyline":
+        if len(parts) == 1:
+            return {"type": "LineString", "coordinates": parts[0]}
+        return {"type": "MultiLineString", "coordinates": parts}
+    if geometry_type == "esriGeometryPolygon":
+        # Esri outer rings are clockwise and are followed by their counter-clockwise holes
+        polygons = []
+        for ring in parts:
+            if _ring_is_clockwise(ring) or not polygons:
+                polygons.append([ring[::-1]])  # GeoJSON outer rings are counter-clockwise
+            else:
+                polygons[-1].append(ring[::-1])
+        if len(polygons) == 1:
+            return {"type": "Polygon", "coordinates": polygons[0]}
+        return {"type": "MultiPolygon", "coordinates": polygons}
+    return None
+
+
+def to_geojson_features(result):
+    """GeoJSON features (x, y[, z]) in the order the server returned them"""
+    dims = 3 if result.has_z else 2
+    features = []
+    for i in range(len(result)):
+        feature = {"type": "Feature",
+                   "geometry": _geojson_geometry(result.geometry_type, result.parts(i), dims),
+                   "properties": result.attributes(i)}
+        if result.object_id_field in result.columns:
+            feature["id"] = result.columns[result.object_id_field][i]
+        features.append(feature)
+    return features
+
+
+def to_esri_json(result):
+    """Esri JSON FeatureSet, as returned by f=json, for tools such as JSONToFeatures"""
+    features = []
+    for i in range(len(result)):
+        parts = result.parts(i)
+        geometry = None
+        if parts is not None:
+            if result.geometry_type == "esriGeometryPoint":
+                geometry = dict(zip(["x", "y", "z" if result.has_z else "m", "m"], parts[0][0]))
+            elif result.geometry_type == "esriGeometryMultipoint":
+                geometry = {"points": [p for part in parts for p in part]}
+            elif result.geometry_type == "esriGeometryPolyline":
+                geometry = {"paths": parts}
+            elif result.geometry_type == "esriGeometryPolygon":
+                geometry = {"rings": parts}
+        features.append({"attributes": result.attributes(i), "geometry": geometry})
+    return {"objectIdFieldName": result.object_id_field,
+            "geometryType": result.geometry_type,
+            "spatialReference": result.spatial_reference,
+            "hasZ": result.has_z,
+            "hasM": result.has_m,
+            "fields": result.fields,
+            "features": features,
+            "exceededTransferLimit": result.exceeded_transfer_limit}
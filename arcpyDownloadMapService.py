@@ -3,7 +3,8 @@
 # Version: 1.0
 #
 # Request a feature class from a arcgis rest api map service. Takes a URL and
-# output feature class as input
+# output feature class as input. Without arcpy the features are written to a
+# GeoPackage or GeoParquet file instead (needs geopandas)
 #
 # Author: https://github.com/jtgis
 #
@@ -11,61 +12,1252 @@
 #
 ################################################################################
 
+from __future__ import print_function
+
+import os
+import re
+import sys
+import csv
 import json
-import arcpy
+import hashlib
 import requests
-import tempfile
-import shutil
+import datetime
+import time
+import random
+import threading
+from array import array
+from collections import deque
+# python 2.7 (arcmap) needs the futures backport for this: pip install futures
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+try:
+    from itertools import izip_longest
+except ImportError:
+    from itertools import zip_longest as izip_longest
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+try:
+    # optional, lets f=pbf responses be decoded (see arcgisPbfDecoder.py)
+    import arcgisPbfDecoder
+except ImportError:
+    arcgisPbfDecoder = None
+
+try:
+    # optional, caches layer metadata and id lists on disk (see httpCache.py)
+    import httpCache
+except ImportError:
+    httpCache = None
+
+url = "www.somemapserviceurl.com/1"
+
+# http statuses and arcgis error codes that mean the server wants us to slow down
+THROTTLE_CODES = (429, 503)
+
+# arcpy isn't thread safe, outputs are written one at a time when mirroring
+arcpyLock = threading.Lock()
+
+def makeSession(poolSize):
+
+    """
+    keep-alive session with room for poolSize connections, metadata and id
+    requests are answered from the shared http cache when it is available
+    """
+
+    session = requests.Session()
+
+    if httpCache is not None:
+        adapter = httpCache.CachingAdapter(pool_maxsize=poolSize)
+    else:
+        adapter = HTTPAdapter(pool_maxsize=poolSize)
+
+    session.mount("http://", adapter)
+
+    session.mount("https://", adapter)
+
+    return session
+
+def printCacheSummary(session):
+
+    cache = getattr(session.get_adapter("https://"), "cache", None)
+
+    if cache is not None:
+        print(cache.summary())
+
+class RateLimiter(object):
+
+    """
+    token bucket shared by the download threads, allows requestsPerSecond on
+    average with bursts of up to burst requests. pause() holds every thread
+    back when the server asks us to slow down
+    """
+
+    def __init__(self,requestsPerSecond,burst=1):
+
+        self.rate = float(requestsPerSecond)
+
+        self.capacity = float(max(burst, 1))
+
+        self.tokens = self.capacity
+
+        self.updated = time.time()
+
+        self.resumeAt = 0.0
+
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+
+            with self.lock:
+
+                now = time.time()
+
+                if now >= self.resumeAt:
+
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+                else:
+
+                    wait = self.resumeAt - now
+
+            time.sleep(wait)
+
+    def pause(self,seconds):
+
+        with self.lock:
+
+            self.resumeAt = max(self.resumeAt, time.time() + seconds)
+
+            self.tokens = 0
+
+            self.updated = self.resumeAt
+
+def throttleError(r):
+
+    """
+    returns True if the response is a throttling error, either as an http
+    status or as an arcgis error json (which arrives with http 200)
+    """
+
+    if r.status_code in THROTTLE_CODES:
+        return True
+
+    # only an error body is parsed here, pages are left for the caller to parse once
+    if 'json' not in r.headers.get('Content-Type', '') or not re.match(br'\s*\{\s*"error"', r.content):
+        return False
+
+    try:
+        error = r.json().get('error')
+    except ValueError:
+        return False
+
+    if not error:
+        return False
+
+    message = "{} {}".format(error.get('message', ''), error.get('details', '')).lower()
+
+    return error.get('code') in THROTTLE_CODES or 'throttl' in message or 'rate limit' in message
+
+def requestWithBackoff(session,url,params,limiter,maxRetries=6,stream=False):
+
+    """
+    one request, waiting on the shared rate limiter and backing off
+    exponentially (or for Retry-After) when the server throttles
+    returns the response
+    """
+
+    delay = 1.0
+
+    for attempt in range(maxRetries + 1):
+
+        limiter.acquire()
+
+        if params and ('geometry' in params or 'objectIds' in params):
+
+            # polygons and id lists can be too long for a url
+            r = session.post(url, data=params)
+
+        else:
+
+            r = session.get(url, params=params, stream=stream)
+
+        if throttleError(r) and attempt < maxRetries:
+
+            retryAfter = r.headers.get('Retry-After', '')
+
+            pause = float(retryAfter) if retryAfter.isdigit() else delay + random.uniform(0, delay)
+
+            print("server is throttling, waiting {:.1f} s".format(pause))
+
+            limiter.pause(pause)
+
+            delay = min(delay * 2, 60)
+
+            r.close()
+
+            continue
+
+        r.raise_for_status()
+
+        return r
+
+def fetchGroup(session,url,params,usePbf,limiter,maxRetries=6):
+
+    """
+    requests one oid group from the layer's query endpoint
+    returns the esri json (or decoded pbf FeatureResult) for the group and the
+    number of bytes downloaded
+    """
+
+    r = requestWithBackoff(session, "{}/query".format(url), params, limiter, maxRetries)
+
+    if usePbf and 'json' not in r.headers.get('Content-Type', ''):
+
+        data = arcgisPbfDecoder.decode(r.content)
+
+    else:
+
+        data = r.json()
+
+        if 'error' in data:
+            raise RuntimeError("query failed: {}".format(data['error']))
+
+    size = len(r.content)
+
+    r.close()
+
+    return data, size
+
+class FeatureBuffer(object):
+
+    """
+    every downloaded feature held as columns, one list per attribute field and
+    the geometries as flat x, y[, z][, m] coordinates in an array with the
+    vertex count of each part, so pages are added without a temp file or
+    feature class per page and written out in one go by a sink
+    """
+
+    def __init__(self):
+
+        self.fields = []
+
+        self.columns = {}
+
+        self.geometryType = None
+
+        self.spatialReference = {}
+
+        self.hasZ = False
+
+        self.hasM = False
+
+        self.coords = array('d')
+
+        self.offsets = [0]  # vertex index where each feature starts
+
+        self.partLengths = []  # vertex count of each part, None for no geometry
+
+    def __len__(self):
+
+        return len(self.partLengths)
+
+    @property
+    def dims(self):
+
+        return 2 + self.hasZ + self.hasM
+
+    def setSchema(self,fields,geometryType,spatialReference,hasZ,hasM):
+
+        # the first page decides the fields and geometry of the output
+        if self.columns:
+            return
+
+        self.fields = [dict(field) for field in fields]
+
+        self.columns = dict((field['name'], []) for field in self.fields)
+
+        self.geometryType = geometryType
+
+        self.spatialReference = spatialReference or {}
+
+        self.hasZ = bool(hasZ)
+
+        self.hasM = bool(hasM)
+
+    def addEsriJson(self,data):
+
+        features = data.get('features') or []
+
+        fields = data.get('fields')
+
+        if not fields and features:
+            fields = [{'name': name, 'type': None} for name in features[0]['attributes']]
+
+        self.setSchema(fields or [], data.get('geometryType'), data.get('spatialReference'),
+                       data.get('hasZ'), data.get('hasM'))
+
+        dims = self.dims
+
+        for name, column in self.columns.items():
+            column.extend([feature['attributes'].get(name) for feature in features])
+
+        for feature in features:
+
+            geometry = feature.get('geometry')
+
+            if not geometry:
+                parts = None
+            elif 'x' in geometry:
+                keys = ['x', 'y'] + ['z'] * self.hasZ + ['m'] * self.hasM
+                parts = [[[geometry.get(key) for key in keys]]] if geometry.get('x') is not None else None
+            elif 'points' in geometry:
+                parts = [geometry['points']]
+            else:
+                parts = geometry.get('paths') or geometry.get('rings')
+
+            if not parts:
+                self.partLengths.append(None)
+                self.offsets.append(self.offsets[-1])
+                continue
+
+            for part in parts:
+                for vertex in part:
+                    # missing z/m values come back as null or are left off
+                    vertex = list(vertex[:dims]) + [None] * (dims - len(vertex))
+                    self.coords.extend([float('nan') if v is None else v for v in vertex])
+
+            self.partLengths.append([len(part) for part in parts])
+
+            self.offsets.append(self.offsets[-1] + sum(self.partLengths[-1]))
+
+    def addPbf(self,result,keep=None):
+
+        """keep lists the indexes of the features to add, default all of them"""
+
+        self.setSchema(result.fields, result.geometry_type, result.spatial_reference,
+                       result.has_z, result.has_m)
+
+        if keep is None:
+
+            for name, column in self.columns.items():
+                column.extend(result.columns.get(name) or [None] * len(result))
+
+            start = self.offsets[-1]
+
+            self.coords.extend(result.coords)
+
+            self.partLengths.extend(result.part_lengths)
+
+            self.offsets.extend([start + offset for offset in result.feature_offsets[1:]])
+
+            return
+
+        for name, column in self.columns.items():
+            values = result.columns.get(name) or [None] * len(result)
+            column.extend([values[i] for i in keep])
+
+        dims = self.dims
+
+        for i in keep:
+
+            start, end = result.feature_offsets[i], result.feature_offsets[i + 1]
+
+            self.coords.extend(result.coords[start * dims:end * dims])
+
+            self.partLengths.append(result.part_lengths[i])
+
+            self.offsets.append(self.offsets[-1] + end - start)
+
+    def add(self,data,seen=None):
+
+        """
+        adds a page of esri json or a pbf FeatureResult; with seen (a set of
+        objectids) features already in it are skipped and new ones recorded
+        """
+
+        if isinstance(data, dict):
+
+            oidField = data.get('objectIdFieldName') or next(
+                (f['name'] for f in data.get('fields') or [] if f.get('type') == "esriFieldTypeOID"), None)
+
+            if seen is not None and oidField:
+
+                features = []
+
+                for feature in data.get('features') or []:
+
+                    oid = feature['attributes'].get(oidField)
+
+                    if oid not in seen:
+                        seen.add(oid)
+                        features.append(feature)
+
+                data = dict(data, features=features)
+
+            self.addEsriJson(data)
+
+        else:
+
+            keep = None
+
+            if seen is not None and data.object_id_field in data.columns:
+
+                keep = []
+
+                for i, oid in enumerate(data.columns[data.object_id_field]):
+
+                    if oid not in seen:
+                        seen.add(oid)
+                        keep.append(i)
+
+            self.addPbf(data, keep)
+
+    def parts(self,i):
+
+        lengths = self.partLengths[i]
+
+        if lengths is None:
+            return None
+
+        dims = self.dims
+
+        pos = self.offsets[i] * dims
+
+        parts = []
+
+        for length in lengths:
+            flat = self.coords[pos:pos + length * dims]
+            parts.append([list(flat[j:j + dims]) for j in range(0, len(flat), dims)])
+            pos += length * dims
+
+        return parts
+
+    def esriGeometry(self,i):
+
+        parts = self.parts(i)
+
+        if parts is None:
+            return None
+
+        if self.geometryType == "esriGeometryPoint":
+            geometry = dict(zip(['x', 'y'] + ['z'] * self.hasZ + ['m'] * self.hasM, parts[0][0]))
+        elif self.geometryType == "esriGeometryMultipoint":
+            geometry = {'points': parts[0]}
+        elif self.geometryType == "esriGeometryPolyline":
+            geometry = {'paths': parts}
+        else:
+            geometry = {'rings': parts}
+
+        if self.hasZ:
+            geometry['hasZ'] = True
+
+        if self.hasM:
+            geometry['hasM'] = True
+
+        geometry['spatialReference'] = self.spatialReference
+
+        return geometry
+
+    def objectIds(self):
+
+        for field in self.fields:
+            if field.get('type') == "esriFieldTypeOID":
+                return self.columns[field['name']]
+
+        return None
+
+    def dateColumn(self,name):
+
+        # esri dates are milliseconds since 1970
+        epoch = datetime.datetime(1970, 1, 1)
+
+        return [None if value is None else epoch + datetime.timedelta(milliseconds=value)
+                for value in self.columns[name]]
+
+ARCPY_SHAPE_TYPES = {"esriGeometryPoint": "POINT",
+                     "esriGeometryMultipoint": "MULTIPOINT",
+                     "esriGeometryPolyline": "POLYLINE",
+                     "esriGeometryPolygon": "POLYGON"}
+
+ARCPY_FIELD_TYPES = {"esriFieldTypeSmallInteger": "SHORT",
+                     "esriFieldTypeInteger": "LONG",
+                     "esriFieldTypeSingle": "FLOAT",
+                     "esriFieldTypeDouble": "DOUBLE",
+                     "esriFieldTypeString": "TEXT",
+                     "esriFieldTypeDate": "DATE",
+                     "esriFieldTypeGUID": "GUID",
+                     "esriFieldTypeGlobalID": "GUID"}
+
+# the output gets its own objectid, and these can't be written from json
+SKIPPED_FIELD_TYPES = ("esriFieldTypeOID", "esriFieldTypeGeometry",
+                       "esriFieldTypeBlob", "esriFieldTypeRaster")
+
+def writeArcpy(features,outLocation,outName):
+
+    """
+    sink that creates the feature class (or table) and fills it with one
+    InsertCursor
+    """
+
+    spatialReference = features.spatialReference
+
+    spatialRef = None
+
+    if spatialReference.get('latestWkid') or spatialReference.get('wkid'):
+        spatialRef = arcpy.SpatialReference(spatialReference.get('latestWkid') or spatialReference.get('wkid'))
+    elif spatialReference.get('wkt'):
+        spatialRef = arcpy.SpatialReference()
+        spatialRef.loadFromString(spatialReference['wkt'])
+
+    hasShape = features.geometryType in ARCPY_SHAPE_TYPES
+
+    if hasShape:
+        arcpy.management.CreateFeatureclass(outLocation, outName,
+                                            ARCPY_SHAPE_TYPES[features.geometryType],
+                                            has_m="ENABLED" if features.hasM else "DISABLED",
+                                            has_z="ENABLED" if features.hasZ else "DISABLED",
+                                            spatial_reference=spatialRef)
+    else:
+        arcpy.management.CreateTable(outLocation, outName)
+
+    outPath = "{}\\{}".format(outLocation,outName)
+
+    fields = [field for field in features.fields if field.get('type') not in SKIPPED_FIELD_TYPES]
+
+    # fields the output made itself (the objectid, the shape and in a geodatabase the
+    # read-only Shape_Length/Shape_Area) keep theirs instead of taking the service's copy
+    taken = set(field.name.lower() for field in arcpy.ListFields(outPath))
+
+    names = []
+
+    columns = []
+
+    for field in fields:
+
+        # service names like Shape.STArea() or SHAPE.LEN aren't valid in the output
+        name = arcpy.ValidateFieldName(field['name'], outLocation)
+
+        if name.lower() in taken:
+            continue
+
+        taken.add(name.lower())
+
+        arcpy.management.AddField(outPath, name,
+                                  ARCPY_FIELD_TYPES.get(field.get('type'), "TEXT"),
+                                  field_length=field.get('length'),
+                                  field_alias=field.get('alias') or field['name'])
+
+        names.append(name)
+
+        if field.get('type') == "esriFieldTypeDate":
+            columns.append(features.dateColumn(field['name']))
+        else:
+            columns.append(features.columns[field['name']])
+
+    cursorFields = names + (["SHAPE@JSON"] if hasShape else [])
+
+    with arcpy.da.InsertCursor(outPath, cursorFields) as iCur:
+
+        for i in range(len(features)):
+
+            row = [column[i] for column in columns]
+
+            if hasShape:
+                geometry = features.esriGeometry(i)
+                row.append(json.dumps(geometry) if geometry else None)
+
+            iCur.insertRow(row)
+
+    return outPath
+
+def shapelyGeometry(geometryType,parts,dims=2):
+
+    """
+    builds a shapely geometry from esri parts, dims is 2 or 3 (x, y and z);
+    shapely has no m so any m value is dropped rather than read as z
+    """
+
+    from shapely.geometry import Point, MultiPoint, LineString, MultiLineString, Polygon, MultiPolygon
+
+    if parts is None or geometryType not in ARCPY_SHAPE_TYPES:
+        return None
+
+    if geometryType == "esriGeometryPoint":
+        return Point(parts[0][0][:dims])
+
+    if geometryType == "esriGeometryMultipoint":
+        return MultiPoint([p[:dims] for p in parts[0]])
+
+    if geometryType == "esriGeometryPolyline":
+        lines = [[p[:dims] for p in part] for part in parts]
+        return LineString(lines[0]) if len(lines) == 1 else MultiLineString(lines)
+
+    # esri outer rings are clockwise and are followed by their holes
+    polygons = []
+
+    for ring in parts:
+
+        ring = [p[:dims] for p in ring]
+
+        area = sum((x2 - x1) * (y2 + y1) for (x1, y1), (x2, y2) in
+                   zip([p[:2] for p in ring], [p[:2] for p in ring[1:]]))
+
+        if area > 0 or not polygons:
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+
+    polygons = [Polygon(rings[0], rings[1:]) for rings in polygons]
+
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+def toGeoDataFrame(features):
+
+    import pandas as pd
+    import geopandas as gpd
+
+    data = {}
+
+    for field in features.fields:
+
+        if field.get('type') == "esriFieldTypeDate":
+            data[field['name']] = pd.to_datetime(features.dateColumn(field['name']))
+        else:
+            data[field['name']] = features.columns[field['name']]
+
+    dims = 2 + features.hasZ
+
+    geometry = [shapelyGeometry(features.geometryType, features.parts(i), dims)
+                for i in range(len(features))]
+
+    spatialReference = features.spatialReference
+
+    code = spatialReference.get('latestWkid') or spatialReference.get('wkid')
+
+    if code:
+        crs = "{}:{}".format("EPSG" if code < 100000 else "ESRI", code)
+    else:
+        crs = spatialReference.get('wkt')
+
+    return gpd.GeoDataFrame(data, geometry=geometry, crs=crs)
+
+def writeGeoPackage(features,outLocation,outName):
+
+    """sink for machines without arcpy, writes outName.gpkg"""
+
+    layer = os.path.splitext(outName)[0]
+
+    outPath = os.path.join(outLocation, layer + ".gpkg")
+
+    toGeoDataFrame(features).to_file(outPath, layer=layer, driver="GPKG")
+
+    return outPath
+
+def writeGeoParquet(features,outLocation,outName):
+
+    """sink for machines without arcpy, writes outName.parquet"""
+
+    outPath = os.path.join(outLocation, os.path.splitext(outName)[0] + ".parquet")
+
+    toGeoDataFrame(features).to_parquet(outPath)
+
+    return outPath
+
+SINKS = {"arcpy": writeArcpy,
+         "gpkg": writeGeoPackage,
+         "parquet": writeGeoParquet}
+
+def bisectExtent(session,url,params,extent,maxRecordCount,usePbf,limiter,
+                 executor,features,progress,maxDepth=16):
+
+    """
+    fallback for old or locked down services that can't list their object
+    ids, so can't be paged: queries the extent (esri json with xmin, ymin,
+    xmax, ymax and spatialReference) as an envelope and splits every cell
+    that comes back truncated (exceededTransferLimit, or maxRecordCount
+    features) into quadrants until each one fits. cells are fetched in
+    parallel and features on cell edges are only added once, by objectid
+    returns the number of bytes downloaded
+    """
+
+    inSR = json.dumps(extent.get('spatialReference') or {})
+
+    pending = {}
+
+    def submit(cell,depth):
+
+        cellParams = dict(params,
+                          geometry=",".join(str(c) for c in cell),
+                          geometryType='esriGeometryEnvelope',
+                          inSR=inSR,
+                          spatialRel='esriSpatialRelIntersects')
+
+        pending[executor.submit(fetchGroup, session, url, cellParams, usePbf, limiter)] = (cell, depth)
+
+    submit((extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax']), 0)
+
+    seen = set()
+
+    bytesTransferred = 0
+
+    cells = 0
+
+    while pending:
+
+        done = wait(list(pending), return_when=FIRST_COMPLETED)[0]
+
+        for future in done:
+
+            cell, depth = pending.pop(future)
+
+            data, size = future.result()
+
+            bytesTransferred += size
+
+            if isinstance(data, dict):
+                count = len(data.get('features') or [])
+                exceeded = data.get('exceededTransferLimit')
+            else:
+                count = len(data)
+                exceeded = data.exceeded_transfer_limit
+
+            if (exceeded or count >= maxRecordCount) and depth < maxDepth:
+
+                xmin, ymin, xmax, ymax = cell
+
+                midX, midY = (xmin + xmax) / 2.0, (ymin + ymax) / 2.0
+
+                for quadrant in ((xmin, ymin, midX, midY), (midX, ymin, xmax, midY),
+                                 (xmin, midY, midX, ymax), (midX, midY, xmax, ymax)):
+                    submit(quadrant, depth + 1)
+
+                continue
+
+            if exceeded:
+                print("cell {} is still over the transfer limit, some features in it are missing".format(cell))
+
+            features.add(data, seen)
+
+            cells += 1
+
+            progress(cells, cells + len(pending), bytesTransferred)
+
+    print("{} features from {} cells".format(len(features), cells))
+
+    return bytesTransferred
+
+# arcpy geometry type of the dissolved selection layer -> rest geometryType
+AOI_GEOMETRY_TYPES = {"polygon": "esriGeometryPolygon",
+                      "polyline": "esriGeometryPolyline",
+                      "multipoint": "esriGeometryMultipoint",
+                      "point": "esriGeometryPoint"}
+
+def prepareAoi(queryLayer,tileSize=None):
+
+    """
+    dissolves the selection layer (polygons, lines or points) into one
+    geometry and returns it with the spatial filters to query with, the whole
+    geometry or, when the aoi is bigger than tileSize (in the layer's units),
+    the geometry clipped to each tileSize square it covers so every request
+    stays small
+    """
+
+    dissolved = arcpy.Dissolve_management(queryLayer,"in_memory/aoi")
+
+    aoi = None
+
+    with arcpy.da.SearchCursor(dissolved, ["SHAPE@"]) as sCur:
+
+        for row in sCur:
+
+            aoi = row[0] if aoi is None else aoi.union(row[0])
+
+    arcpy.Delete_management(dissolved)
+
+    if aoi is None:
+        raise ValueError("the query layer has no features")
+
+    geometryType = AOI_GEOMETRY_TYPES[aoi.type]
+
+    spatialRef = aoi.spatialReference
+
+    if spatialRef.factoryCode:
+        inSR = json.dumps({"wkid": spatialRef.factoryCode})
+    else:
+        inSR = json.dumps({"wkt": spatialRef.exportToString()})
+
+    pieces = [aoi]
+
+    extent = aoi.extent
 
-url = "www.somemapserviceurl.com/1"
+    if tileSize and (extent.width > tileSize or extent.height > tileSize):
+
+        pieces = []
+
+        y = extent.YMin
+
+        while y < extent.YMax:
+
+            x = extent.XMin
+
+            while x < extent.XMax:
+
+                tile = arcpy.Extent(x, y, min(x + tileSize, extent.XMax),
+                                    min(y + tileSize, extent.YMax))
+
+                piece = aoi.clip(tile)
+
+                # lines and points have no area, they only need something left in the tile
+                if piece.area > 0 or (aoi.type != "polygon" and not piece.isEmpty):
+                    pieces.append(piece)
+
+                x += tileSize
+
+            y += tileSize
+
+        print("selection area split into {} tiles".format(len(pieces)))
+
+    filters = [{'geometry': piece.JSON,
+                'geometryType': geometryType,
+                'inSR': inSR,
+                'spatialRel': 'esriSpatialRelIntersects'} for piece in pieces]
+
+    return aoi, filters
+
+MANIFEST_FIELDS = ["parentObjectId", "parentGlobalId", "attachmentId", "name",
+                   "contentType", "size", "sha256", "path"]
+
+def openCsv(path,mode):
+
+    # the csv module wants binary files on python 2 and text files on 3
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+
+    return open(path, mode, newline='')
+
+def downloadAttachment(session,attachment,path,limiter):
+
+    """
+    streams one attachment to path, through a temp file so an interrupted
+    download is never mistaken for a finished one
+    returns the sha256 of the file and its size
+    """
+
+    r = requestWithBackoff(session, attachment['url'], None, limiter, stream=True)
+
+    checksum = hashlib.sha256()
+
+    size = 0
+
+    tmpPath = path + ".part"
+
+    with open(tmpPath, 'wb') as f:
+
+        for chunk in r.iter_content(chunk_size=65536):
+
+            f.write(chunk)
+
+            checksum.update(chunk)
+
+            size += len(chunk)
+
+    r.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    os.rename(tmpPath, path)
+
+    return checksum.hexdigest(), size
+
+def downloadAttachments(url,outFolder,query="",oidList=None,maxWorkers=4,
+                        requestsPerSecond=2.0,chunkSize=500,session=None,
+                        limiter=None,executor=None):
+
+    """
+    downloads every attachment of the features matching query (or of the
+    features in oidList) into outFolder/<parent objectid>/, listing them with
+    queryAttachments in chunks of chunkSize objectids and downloading the
+    files concurrently. attachments.csv links each file to its parent
+    feature; files already on disk with the same size, and the checksum the
+    manifest recorded for them, are skipped on a rerun
+    returns the manifest path
+    """
+
+    ownPool = executor is None
+
+    if session is None:
+        session = makeSession(maxWorkers)
+
+    if limiter is None:
+        limiter = RateLimiter(requestsPerSecond, burst=maxWorkers)
+
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=maxWorkers)
+
+    downloads = []
+
+    try:
+
+        if oidList is None:
+
+            data, size = fetchGroup(session, url, {"where": query or '1=1',
+                                                   "f": "json",
+                                                   "returnIdsOnly": True}, False, limiter)
+
+            oidList = data['objectIds'] or []
+
+        oidList = sorted(oidList)
+
+        if not os.path.isdir(outFolder):
+            os.makedirs(outFolder)
+
+        manifestPath = os.path.join(outFolder, "attachments.csv")
+
+        # checksums recorded by the last run, by parent and attachment id
+        previous = {}
+
+        if os.path.exists(manifestPath):
+
+            with openCsv(manifestPath, 'r') as f:
+
+                for row in csv.DictReader(f):
+                    previous[(row['parentObjectId'], row['attachmentId'])] = row
+
+        def listChunk(chunk):
+
+            params = {'objectIds': ','.join(str(i) for i in chunk),
+                      'returnUrl': True,
+                      'f': 'json'}
+
+            r = requestWithBackoff(session, "{}/queryAttachments".format(url), params, limiter)
+
+            data = r.json()
+
+            r.close()
+
+            if 'error' in data:
+                raise RuntimeError("queryAttachments failed: {}".format(data['error']))
+
+            return data.get('attachmentGroups') or []
+
+        chunks = [oidList[i:i + chunkSize] for i in range(0, len(oidList), chunkSize)]
+
+        rows = []
 
-def downloadRestFeatures(url,queryLayer,query,outLocation,outName):
+        for groups in executor.map(listChunk, chunks):
+
+            for group in groups:
+
+                parent = group['parentObjectId']
+
+                for attachment in group.get('attachmentInfos') or []:
+
+                    if not attachment.get('url'):
+                        attachment['url'] = "{}/{}/attachments/{}".format(url, parent, attachment['id'])
+
+                    name = re.sub(r'[\\/:*?"<>|]+', "_", attachment.get('name') or str(attachment['id']))
+
+                    rows.append({'parentObjectId': parent,
+                                 'parentGlobalId': group.get('parentGlobalId', ""),
+                                 'attachmentId': attachment['id'],
+                                 'name': attachment.get('name', ""),
+                                 'contentType': attachment.get('contentType', ""),
+                                 'size': attachment.get('size'),
+                                 'path': os.path.join(str(parent), "{}_{}".format(attachment['id'], name)),
+                                 'url': attachment['url']})
+
+        print("{} attachments on {} features".format(len(rows), len(oidList)))
+
+        # the manifest is written as files complete, so an interrupted run
+        # still records what it got and the rerun only fetches the rest
+        with openCsv(manifestPath, 'w') as f:
+
+            writer = csv.DictWriter(f, MANIFEST_FIELDS, extrasaction='ignore')
+
+            writer.writeheader()
+
+            skipped = 0
+
+            for row in rows:
+
+                path = os.path.join(outFolder, row['path'])
+
+                last = previous.get((str(row['parentObjectId']), str(row['attachmentId'])))
+
+                if (last is not None and os.path.exists(path) and
+                        os.path.getsize(path) == row['size'] and
+                        last['size'] == str(row['size']) and last['sha256']):
+
+                    # checksums are only worked out for files the size says are complete
+                    checksum = hashlib.sha256()
+
+                    with open(path, 'rb') as attachmentFile:
+                        for chunk in iter(lambda: attachmentFile.read(65536), b""):
+                            checksum.update(chunk)
+
+                    if checksum.hexdigest() == last['sha256']:
+                        row['sha256'] = last['sha256']
+                        writer.writerow(row)
+                        skipped += 1
+                        continue
+
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                downloads.append((row, executor.submit(downloadAttachment, session, row, path, limiter)))
+
+            f.flush()
+
+            bytesTransferred = 0
+
+            failed = 0
+
+            startTime = time.time()
+
+            for done, (row, future) in enumerate(downloads, 1):
+
+                try:
+
+                    row['sha256'], size = future.result()
+
+                except (requests.RequestException, RuntimeError, EnvironmentError) as e:
+
+                    # listed without a checksum so the next run tries it again
+                    print("attachment {} of feature {} failed: {}".format(row['attachmentId'], row['parentObjectId'], e))
+
+                    row['sha256'] = ""
+
+                    failed += 1
+
+                else:
+
+                    bytesTransferred += size
+
+                    if row['size'] is None:
+                        row['size'] = size
+
+                writer.writerow(row)
+
+                f.flush()
+
+                if done % 50 == 0 or done == len(downloads):
+                    print("{} of {} attachments, {:.1f} MB".format(done, len(downloads), bytesTransferred / 1e6))
+
+        print("{} attachments downloaded ({:.1f} MB in {:.1f} s), {} already up to date, {} failed".format(
+            len(downloads) - failed, bytesTransferred / 1e6, time.time() - startTime, skipped, failed))
+
+    finally:
+
+        # nothing queued should outlive an error
+        for row, future in downloads:
+            future.cancel()
+
+        if ownPool:
+
+            executor.shutdown()
+
+            session.close()
+
+    return manifestPath
+
+def downloadRestFeatures(url,queryLayer,query,outLocation,outName,transport="json",
+                         maxAllowableOffset=None,geometryPrecision=None,
+                         quantizationParameters=None,maxWorkers=4,
+                         requestsPerSecond=2.0,tileSize=None,exactFilter=False,
+                         sink=None,session=None,limiter=None,executor=None,
+                         layerInfo=None,progress=None,attachmentsFolder=None):
     
     """
     #https://gis.stackexchange.com/questions/324513/converting-rest-service-to-file-geodatabase-feature-class
     can export a map service to fc optionally add a query or selection layer
     to limit ouput or leave those as "" to get the whole thing
+    transport="pbf" requests protobuf responses, which are much smaller, and
+    falls back to json if the service does not list PBF as a query format
+    maxAllowableOffset, geometryPrecision and quantizationParameters (a dict)
+    are passed to the query so the server generalizes geometry before sending
+    it; the settings used are written to the output's metadata
+    oid groups are downloaded by maxWorkers threads over one keep-alive
+    session, limited to requestsPerSecond, and written to the output in order
+    a queryLayer is dissolved once and sent as a polygon intersect filter,
+    split into tileSize tiles for large areas; exactFilter=True also drops
+    features that don't intersect it locally before writing the output
+    services that can't list their object ids are downloaded by splitting
+    the extent into cells instead (see bisectExtent)
+    responses are parsed into one FeatureBuffer and written once by sink,
+    "arcpy" (the default when arcpy is installed), "gpkg" (the default
+    without it), "parquet" or any function taking (features, outLocation,
+    outName) and returning the output path
+    session, limiter and executor can be shared between calls (see
+    mirrorService), layerInfo is the layer's f=json metadata if it is already
+    known and progress is called with (groups done, groups, bytes)
+    attachmentsFolder also downloads the features' attachments there (see
+    downloadAttachments)
     returns the new fc
     """
 
     if not query:
         query = '1=1'
-    
-    data1 = requests.get("{}/query".format(url), {"where": query,
-                                                  "f": "json",
-                                                  "returnCountOnly": True}).json()
-    
-    print(data1['count'])
-               
-    data2 = requests.get("{}/query".format(url), {"where": query,
-                                                  "f": "json",
-                                                  "returnIdsOnly": True}).json()
-    
-    oidList = data2['objectIds']
-    
-    oidFieldName = data2['objectIdFieldName']
-               
-    data3 = requests.get(url, {"where": query,
-                               "f": "json",
-                               "returnIdsOnly": True}).json()
+
+    if sink is None:
+        sink = "arcpy" if arcpy is not None else "gpkg"
+
+    if not callable(sink):
+        sink = SINKS[sink]
+
+    if queryLayer and arcpy is None:
+        raise RuntimeError("a queryLayer needs arcpy")
+
+    if exactFilter and sink is not writeArcpy:
+        raise ValueError("exactFilter needs the arcpy sink")
+
+    # a session, limiter and pool passed in are shared with other downloads
+    # and are left open
+    ownPool = executor is None
+
+    if session is None:
+        session = makeSession(maxWorkers)
+
+    if limiter is None:
+        limiter = RateLimiter(requestsPerSecond, burst=maxWorkers)
+
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=maxWorkers)
+
+    if progress is None:
+        progress = lambda done, total, size: print("{} of {}".format(done, total))
+
+    bytesTransferred = 0
+
+    startTime = time.time()
+
+    # stays None if the service can't list its object ids
+    oidList = None
+
+    if not queryLayer:
+
+        try:
+            data2, size = fetchGroup(session, url, {"where": query,
+                                                    "f": "json",
+                                                    "returnIdsOnly": True}, False, limiter)
+        except (RuntimeError, requests.RequestException, ValueError) as e:
+            print("can't list object ids: {}".format(e))
+            data2, size = {}, 0
+
+        bytesTransferred += size
+
+        if 'objectIds' in data2:
+        
+            oidList = data2['objectIds'] or []
+            
+            oidFieldName = data2['objectIdFieldName']
+
+            print(len(oidList))
+
+    data3 = layerInfo
+
+    if data3 is None:
+
+        limiter.acquire()
+
+        data3 = session.get(url, params={"f": "json"}).json()
 
     n = data3['maxRecordCount']
 
     print(n)
 
+    usePbf = (transport == "pbf" and arcgisPbfDecoder is not None and
+              arcgisPbfDecoder.supports_pbf(data3))
+
+    if transport == "pbf" and not usePbf:
+        print("pbf not available for this service, using json")
+
+    geometryOptions = {}
+
+    if maxAllowableOffset:
+        geometryOptions['maxAllowableOffset'] = maxAllowableOffset
+
+    if geometryPrecision is not None:
+        geometryOptions['geometryPrecision'] = geometryPrecision
+
+    if quantizationParameters:
+        geometryOptions['quantizationParameters'] = json.dumps(quantizationParameters)
+
+    if queryLayer:
+
+        # the ids inside the selection area are looked up once per tile, the
+        # groups are then fetched by id without sending the polygon again
+        aoi, filters = prepareAoi(queryLayer, tileSize)
+
+        idParams = [dict(spatialFilter, where=query, returnIdsOnly=True, f='json')
+                    for spatialFilter in filters]
+
+        oidSet = set()
+
+        try:
+
+            for data, size in executor.map(lambda params: fetchGroup(session, url, params, False, limiter),
+                                           idParams):
+
+                if 'objectIds' not in data:
+                    raise RuntimeError("no objectIds in the response")
+
+                # features crossing tile edges come back for each tile
+                oidSet.update(data['objectIds'] or [])
+
+                oidFieldName = data.get('objectIdFieldName')
+
+                bytesTransferred += size
+
+            oidList = list(oidSet)
+
+            print("{} features in the selection area".format(len(oidList)))
+
+        except (RuntimeError, requests.RequestException, ValueError) as e:
+            print("can't list object ids: {}".format(e))
+
+    features = FeatureBuffer()
+
+    if oidList is None:
+
+        if queryLayer:
+            extent = {'xmin': aoi.extent.XMin, 'ymin': aoi.extent.YMin,
+                      'xmax': aoi.extent.XMax, 'ymax': aoi.extent.YMax,
+                      'spatialReference': json.loads(filters[0]['inSR'])}
+        else:
+            extent = data3['extent']
+
+        print("splitting the extent into cells instead")
+
+        cellParams = dict(geometryOptions, where=query, outFields='*', returnGeometry=True,
+                          f='pbf' if usePbf else 'pjson')
+
+        bytesTransferred += bisectExtent(session, url, cellParams, extent, n, usePbf,
+                                         limiter, executor, features, progress)
+
+        oidList = []
+
     oidList.sort()
     
     list_of_groups = izip_longest(*(iter(oidList),) * n)
-    
-    x=1
+
+    allParams = []
     
     for group in list_of_groups:
-
-        time.sleep(2)
-        
-        print(x)
-        
-        x=x+1
         
         group = [i for i in group if i is not None]
 
@@ -74,6 +1266,10 @@ def downloadRestFeatures(url,queryLayer,query,outLocation,outName):
         lastNUMB = group[-1]
         
         queryParam = '{} BETWEEN {} AND {}'.format(oidFieldName,firstNUMB,lastNUMB)
+
+        if query != '1=1':
+            # the range also covers ids in between that don't match the query
+            queryParam = '({}) AND {}'.format(query, queryParam)
         
         params = {'where': queryParam,
                   'outFields': '*',
@@ -82,67 +1278,222 @@ def downloadRestFeatures(url,queryLayer,query,outLocation,outName):
         
         if queryLayer:
             
-            spatial_ref = arcpy.Describe(queryLayer).spatialReference
-            
-            dissolved = arcpy.Dissolve_management(queryLayer,"dissolved")
-            
-            arcpy.AddGeometryAttributes_management(dissolved,
-                                                   "EXTENT")
-            
-            with arcpy.da.SearchCursor(dissolved, ["OID@", "EXT_MIN_X", "EXT_MIN_Y","EXT_MAX_X", "EXT_MAX_Y"]) as sCur:
-                
-                for row in sCur:
-                    
-                    minX, minY, maxX, maxY = row[1], row[2], row[3], row[4]
-                    
-            extent = (str(minX) +","+ str(minY) +","+ str(maxX) +","+ str(maxY))
-            
-            params = {'where': queryParam,
-                      'geometry': extent,
-                      'geometryType':
-                      'esriGeometryEnvelope ',
-                      'inSR': spatial_ref,
-                      'spatialRel':
-                      'esriSpatialRelIntersects',
+            params = {'objectIds': ','.join(str(i) for i in group),
                       'outFields': '*',
                       'f': 'pjson',
                       'returnGeometry': True}
             
-        r = requests.get("{}/query".format(url), params)
-        
-        data = r.json()
-        
-        dirpath = tempfile.mkdtemp()
-        
-        json_path = r"{}\mapService.json".format(dirpath)
+        params.update(geometryOptions)
+
+        if usePbf:
+
+            params['f'] = 'pbf'
+
+        allParams.append(params)
+
+    # only a few groups are queued ahead so finished downloads don't pile up
+    # in memory before they are added to the buffer in order
+    pending = deque()
+
+    remaining = iter(allParams)
+
+    for params in remaining:
+
+        pending.append(executor.submit(fetchGroup, session, url, params, usePbf, limiter))
+
+        if len(pending) >= maxWorkers * 2:
+            break
+
+    x=1
+
+    while pending:
+
+        data, size = pending.popleft().result()
+
+        for params in remaining:
+            pending.append(executor.submit(fetchGroup, session, url, params, usePbf, limiter))
+            break
+
+        bytesTransferred += size
         
-        with open(json_path, 'w') as f:
-            json.dump(data, f)
-        f.close()
-        r.close()
+        progress(x, len(allParams), bytesTransferred)
         
-        arcpy.JSONToFeatures_conversion(json_path,
-                                        "in_memory/singleFeature")
+        x=x+1
+
+        features.add(data)
 
-        if arcpy.Exists("in_memory/allFeatures"):
-            arcpy.management.Append(["in_memory/singleFeature"],
-                                    "in_memory/allFeatures","TEST")
+    with arcpyLock:
+        outPath = sink(features, outLocation, outName)
+
+    if attachmentsFolder:
+
+        if data3.get('hasAttachments'):
+            downloadAttachments(url, attachmentsFolder, query, oidList=features.objectIds(),
+                                maxWorkers=maxWorkers, session=session, limiter=limiter,
+                                executor=executor)
         else:
-            arcpy.conversion.FeatureClassToFeatureClass("in_memory/singleFeature",
-                                                        "in_memory",
-                                                        "allFeatures")
+            print("{} has no attachments".format(url))
 
-        arcpy.Delete_management("in_memory/singleFeature")
+    if ownPool:
 
-    arcpy.conversion.FeatureClassToFeatureClass("in_memory/allFeatures",
-                                                outLocation,outName)
+        executor.shutdown()
 
-    shutil.rmtree(dirpath)
-    arcpy.Delete_management("in_memory/allFeatures")
-        
-    return "{}\{}".format(outLocation,outName)
+        printCacheSummary(session)
+
+        session.close()
+
+    if queryLayer and exactFilter:
+
+        # the server's intersect uses its own tolerance and projection, this
+        # drops anything that doesn't touch the selection polygon as drawn
+        outLayer = arcpy.management.MakeFeatureLayer(outPath,"outFeaturesLayer")
+
+        arcpy.management.SelectLayerByLocation(outLayer,"INTERSECT",aoi,
+                                               invert_spatial_relationship="INVERT")
+
+        arcpy.management.DeleteFeatures(outLayer)
+
+        arcpy.Delete_management(outLayer)
+
+    elapsed = time.time() - startTime
+
+    print("{} bytes downloaded in {:.1f} s".format(bytesTransferred, elapsed))
+
+    settings = "Downloaded from {} where {} using {}, geometry options: {}".format(
+        url, query, "pbf" if usePbf else "json",
+        json.dumps(geometryOptions) if geometryOptions else "full resolution")
+
+    try:
+        # arcpy.metadata is only available in ArcGIS Pro
+        from arcpy import metadata as md
+        with arcpyLock:
+            itemMetadata = md.Metadata(outPath)
+            itemMetadata.summary = settings
+            itemMetadata.save()
+    except Exception:
+        print(settings)
+
+    return outPath
+
+def mirrorService(serviceUrl,outLocation,transport="json",maxWorkers=8,
+                  requestsPerSecond=4.0,layerWorkers=4,sink=None,**options):
+
+    """
+    downloads every layer and table of a MapServer or FeatureServer into
+    outLocation. the layer list and each layer's metadata are read once,
+    layerWorkers layers download at the same time and all of their requests
+    share one session, one pool of maxWorkers threads and one
+    requestsPerSecond budget. options are passed on to downloadRestFeatures
+    (e.g. maxAllowableOffset)
+    returns {layer name: output path, or the error if that layer failed}
+    """
+
+    serviceUrl = serviceUrl.rstrip("/")
+
+    session = makeSession(maxWorkers + layerWorkers)
+
+    limiter = RateLimiter(requestsPerSecond, burst=maxWorkers)
+
+    # /layers returns the full metadata of every layer and table in one
+    # request, older servers only have the summaries on the service itself
+    limiter.acquire()
+
+    info = session.get("{}/layers".format(serviceUrl), params={"f": "json"}).json()
+
+    if 'error' in info or 'layers' not in info:
+
+        limiter.acquire()
+
+        info = session.get(serviceUrl, params={"f": "json"}).json()
+
+    layers = []
+
+    outNames = set()
+
+    for layer in (info.get('layers') or []) + (info.get('tables') or []):
+
+        if layer.get('subLayerIds') or layer.get('type', "Table") not in ("Feature Layer", "Table"):
+            continue
+
+        if arcpy is not None:
+            outName = arcpy.ValidateTableName(layer['name'], outLocation)
+        else:
+            outName = re.sub(r"\W+", "_", layer['name']).strip("_") or "layer"
+
+        if outName in outNames:
+            outName = "{}_{}".format(outName, layer['id'])
+
+        outNames.add(outName)
+
+        # only full layer metadata has maxRecordCount
+        layers.append((layer, outName, layer if 'maxRecordCount' in layer else None))
+
+    print("mirroring {} layers from {}".format(len(layers), serviceUrl))
+
+    executor = ThreadPoolExecutor(max_workers=maxWorkers)
+
+    layerPool = ThreadPoolExecutor(max_workers=layerWorkers)
+
+    startTime = time.time()
+
+    def mirrorLayer(layer, outName, layerInfo):
+
+        layerStart = time.time()
+
+        layerOptions = dict(options)
+
+        if options.get('attachmentsFolder'):
+            # each layer's attachments and manifest get their own folder
+            layerOptions['attachmentsFolder'] = os.path.join(options['attachmentsFolder'], outName)
+
+        def progress(done, total, size):
+
+            seconds = max(time.time() - layerStart, 0.001)
+
+            print("{}: {} of {} groups, {:.1f} MB, {:.2f} MB/s".format(
+                outName, done, total, size / 1e6, size / 1e6 / seconds))
+
+        return downloadRestFeatures("{}/{}".format(serviceUrl, layer['id']), "", "",
+                                    outLocation, outName, transport=transport,
+                                    maxWorkers=maxWorkers, sink=sink, session=session,
+                                    limiter=limiter, executor=executor,
+                                    layerInfo=layerInfo, progress=progress, **layerOptions)
+
+    futures = [(outName, layerPool.submit(mirrorLayer, layer, outName, layerInfo))
+               for layer, outName, layerInfo in layers]
+
+    results = {}
+
+    for outName, future in futures:
+
+        # one broken layer shouldn't stop the rest of the mirror
+        try:
+            results[outName] = future.result()
+        except Exception as e:
+            print("{} failed: {}".format(outName, e))
+            results[outName] = e
+
+    layerPool.shutdown()
+
+    executor.shutdown()
+
+    printCacheSummary(session)
+
+    session.close()
+
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+
+    print("mirrored {} of {} layers in {:.1f} s".format(
+        len(results) - len(failed), len(results), time.time() - startTime))
+
+    return results
+
+if __name__ == "__main__":
+
+    tempFc = downloadRestFeatures(url,"","","in_memory","test")
 
-tempFc = downloadRestFeatures(url,"","","in_memory","test")
+    print([f.name for f in arcpy.ListFields(tempFc)])
 
-print [f.name for f in arcpy.ListFields(tempFc)]
+    # or mirror every layer and table of the service
+    # mirrorService(url.rsplit("/", 1)[0], "in_memory")
     
@@ -0,0 +1,231 @@
+"""Benchmark cameraMetadataChecker on a synthetic JPEG corpus whose expected metadata doubles as parser fixtures"""
+import os, sys, time, json, struct, shutil, argparse, calendar, tempfile
+import cameraMetadataChecker as checker
+
+PAGE_FILL = bytes(range(0xFE)) * 64  # Stand-in for entropy-coded image data (no 0xFF, so no markers)
+SOI, EOI = b'\xff\xd8', b'\xff\xd9'
+
+XMP_DJI = ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?><x:xmpmeta xmlns:x="adobe:ns:meta/">'
+           '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description rdf:about="" '
+           'xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" drone-dji:GimbalRollDegree="{roll:+.2f}" '
+           'drone-dji:GimbalPitchDegree="{pitch:+.2f}" drone-dji:GimbalYawDegree="{yaw:+.2f}" '
+           'drone-dji:FlightRollDegree="+9.99"/></rdf:RDF></x:xmpmeta>' + ' ' * 2048 + '<?xpacket end="w"?>')
+XMP_ELEMENTS = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+                '<rdf:Description rdf:about="" xmlns:Camera="http://pix4d.com/camera/1.0/"><Camera:Roll>{roll}</Camera:Roll>'
+                '<Camera:Pitch>{pitch}</Camera:Pitch><Camera:Yaw>{yaw}</Camera:Yaw></rdf:Description></rdf:RDF></x:xmpmeta>')
+XMP_PARTIAL = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+               '<rdf:Description xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" drone-dji:GimbalRollDegree="{roll}" '
+               'drone-dji:GimbalPitchDegree="{pitch}"/></rdf:RDF></x:xmpmeta>')
+XMP_MALFORMED = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:Description drone-dji:FlightRollDegree="{roll}" '
+                 'drone-dji:FlightPitchDegree="{pitch}" drone-dji:FlightYawDegree="{yaw}">')  # Unclosed, undeclared prefix
+
+
+# ----- Synthetic JPEG writer -----
+
+def segment(marker, payload):
+    return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+
+def ifd(order, entries, offset):
+    """One IFD at offset (from the TIFF header) → bytes; entries are (tag, type, count, packed value)"""
+    out, data = struct.pack(order + 'H', len(entries)), b''
+    data_at = offset + 2 + 12 * len(entries) + 4
+    for tag, ttype, count, value in entries:
+        if len(value) <= 4: out += struct.pack(order + 'HHI', tag, ttype, count) + value.ljust(4, b'\x00')
+        else:
+            out += struct.pack(order + 'HHII', tag, ttype, count, data_at + len(data))
+            data += value + b'\x00' * (len(value) % 2)  # Values start on word boundaries
+    return out + struct.pack(order + 'I', 0) + data
+
+
+def ascii_entry(tag, text): return (tag, 2, len(text) + 1, text.encode() + b'\x00')
+def rational_entry(order, tag, *pairs): return (tag, 5, len(pairs), b''.join(struct.pack(order + 'II', *p) for p in pairs))
+
+
+def tiff(order, ifd0, exif_ifd, gps_ifd):
+    """TIFF block: header, IFD0 (+ pointers to the EXIF and GPS IFDs when given)"""
+    def build(exif_at, gps_at):
+        entries = list(ifd0)
+        if exif_ifd: entries.append((0x8769, 4, 1, struct.pack(order + 'I', exif_at)))
+        if gps_ifd: entries.append((0x8825, 4, 1, struct.pack(order + 'I', gps_at)))
+        return ifd(order, entries, 8)
+    exif_at = 8 + len(build(0, 0))
+    exif = ifd(order, exif_ifd, exif_at) if exif_ifd else b''
+    gps_at = exif_at + len(exif)
+    gps = ifd(order, gps_ifd, gps_at) if gps_ifd else b''
+    return (b'II' if order == '<' else b'MM') + struct.pack(order + 'HI', 42, 8) + build(exif_at, gps_at) + exif + gps
+
+
+def dms(order, tag, value):
+    """GPS degrees/minutes/seconds rationals for |value| → (entry, the value the parser should decode)"""
+    value = abs(value)
+    d, m = int(value), int(value % 1 * 60)
+    s = round((value * 3600 - d * 3600 - m * 60) * 10000)
+    return rational_entry(order, tag, (d, 1), (m, 1), (s, 10000)), d + m / 60 + s / 10000 / 3600
+
+
+def jpeg(size, exif=None, xmp=None):
+    """SOI, APP0, EXIF APP1, APP2, XMP APP1 (after fill bytes), DQT, SOF0, SOS, image data padded to size, EOI"""
+    head = SOI + segment(0xE0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    if exif is not None: head += segment(0xE1, b'Exif\x00\x00' + exif)
+    head += segment(0xE2, b'ICC_PROFILE\x00\x01\x01' + b'\x00' * 512)
+    if xmp is not None: head += b'\xff\xff' + segment(0xE1, checker.XMP_HEADER + xmp.encode())
+    head += segment(0xDB, b'\x00' + bytes(64)) + segment(0xC0, b'\x08\x0f\xa0\x0b\xb8\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+    head += segment(0xDA, b'\x03\x01\x00\x02\x11\x03\x11\x00\x3f\x00')
+    fill = max(0, size - len(head) - 2)
+    return head + (PAGE_FILL * (fill // len(PAGE_FILL) + 1))[:fill] + EOI
+
+
+def make_image(case, i, size):
+    """(file bytes, the check_image result it must produce) for corpus case name at index i"""
+    expected = dict(checker.EMPTY)
+    if case == 'not_jpeg': return b'\x89PNG\r\n\x1a\n' + bytes(1024), expected
+    if case == 'empty': return b'', expected
+
+    order = '>' if case.startswith('be_') or case == 'truncated_data' and i % 2 else '<'
+    make, model, focal = ('SONY', 'DSC-RX1RM2', 35.0) if order == '>' else ('DJI', 'FC6310', 8.8)
+    roll, pitch, yaw = round(i % 7 - 3.0, 2), round(-90 + i % 11, 2), round(i * 3.7 % 360 - 180, 2)
+    seconds = calendar.timegm((2026, 5, 1, 10, 0, 0)) + i * 2
+    ifd0 = [] if case == 'no_sensor' else [ascii_entry(0x010F, make), ascii_entry(0x0110, model)]
+    exif_ifd = [ascii_entry(0x9003, time.strftime('%Y:%m:%d %H:%M:%S', time.gmtime(seconds))),
+                ascii_entry(0x9291, '25'), rational_entry(order, 0x920A, (int(focal * 10), 10))]
+
+    gps_ifd = None
+    if case != 'le_no_gps':
+        south_west = order == '>'  # Big-endian images sit in the south-west with a below-sea-level altitude
+        lat_entry, lat = dms(order, 0x0002, 45.9 + i * 1e-4)
+        lon_entry, lon = dms(order, 0x0004, 66.6 + i * 1e-4)
+        alt = 120.5 + i % 5
+        gps_ifd = [ascii_entry(0x0001, 'S' if south_west else 'N'), lat_entry, ascii_entry(0x0003, 'W' if south_west else 'E'),
+                   lon_entry, (0x0005, 1, 1, b'\x01' if south_west else b'\x00'), rational_entry(order, 0x0006, (int(alt * 10), 10))]
+        sign = -1 if south_west else 1
+        expected.update(gps=True, lat=sign * lat, lon=sign * lon, alt=sign * alt)
+
+    xmp = {'be_no_xmp': None, 'xmp_partial': XMP_PARTIAL, 'xmp_malformed': XMP_MALFORMED}.get(
+        case, XMP_ELEMENTS if order == '>' else XMP_DJI)
+    if xmp is not None:
+        expected.update(roll=roll, pitch=pitch)
+        if case != 'xmp_partial': expected.update(orientation=True, yaw=yaw)
+        xmp = xmp.format(roll=roll, pitch=pitch, yaw=yaw)
+
+    if case != 'no_sensor': expected.update(sensor=True, make=make, model=model)
+    expected.update(focal=focal, time=seconds + 0.25)
+    if case == 'bad_types':  # Make as UNDEFINED bytes, model and focal/altitude with two values: read as missing
+        ifd0 = [(0x010F, 7, 4, make.encode()[:4].ljust(4)), (0x0110, 3, 2, struct.pack(order + 'HH', 1, 2))]
+        exif_ifd[2] = rational_entry(order, 0x920A, (88, 10), (88, 10))
+        gps_ifd[5] = rational_entry(order, 0x0006, (1205, 10), (1205, 10))
+        expected.update(gps=False, alt=None, sensor=False, make=None, model=None, focal=None)
+    data = jpeg(size, tiff(order, ifd0, exif_ifd, gps_ifd), xmp)
+
+    if case == 'truncated_data': data = data[:len(data) - max(2, (len(data) - 8192) // 2)]  # Header intact
+    if case == 'truncated_header':  # Cut inside the EXIF APP1 header: nothing can be read
+        data, expected = data[:data.index(b'\xff\xe1') + 8], dict(checker.EMPTY)
+    return data, expected
+
+
+CASES = ['le_dji', 'be_pix4d', 'le_no_gps', 'be_no_xmp', 'xmp_partial', 'xmp_malformed', 'no_sensor', 'bad_types',
+         'truncated_data', 'truncated_header', 'not_jpeg', 'empty']
+
+def make_corpus(folder, count, size):
+    """Write count images cycling through CASES + expected.json (relative path → check_image result)"""
+    os.makedirs(folder, exist_ok=True)
+    expected = {}
+    for i in range(count):
+        case = CASES[i % len(CASES)]
+        name = f"{i:06d}_{case}.jpg"
+        data, expected[name] = make_image(case, i, size)
+        with open(os.path.join(folder, name), 'wb') as f: f.write(data)
+    with open(os.path.join(folder, "expected.json"), 'w') as f: json.dump(expected, f, indent=1)
+    return expected
+
+
+# ----- Measurement -----
+
+def proc_stats(pid):
+    """(bytes read from storage, peak RSS bytes) of a process from /proc, or None where that isn't available"""
+    try:
+        with open(f'/proc/{pid}/io') as f: io = dict(line.split(': ') for line in f.read().splitlines())
+        with open(f'/proc/{pid}/status') as f: hwm = next(line for line in f if line.startswith('VmHWM'))
+        return int(io['read_bytes']), int(hwm.split()[1]) * 1024
+    except (OSError, StopIteration, KeyError, ValueError): return None
+
+
+def evict(paths):
+    """Drop the corpus from the page cache so every run reads from storage like a fresh survey would"""
+    if hasattr(os, 'sync'): os.sync()  # Dirty pages of the freshly written corpus can't be dropped
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally: os.close(fd)
+        except (OSError, AttributeError): return False
+    return True
+
+
+def differences(got, want):
+    """Fields where a check_image result differs from the fixture (floats to 1e-6)"""
+    bad = []
+    for k, v in want.items():
+        g = got.get(k)
+        same = abs(g - v) <= 1e-6 if isinstance(v, float) and isinstance(g, float) else g == v
+        if not same: bad.append(f"{k}={g!r} (expected {v!r})")
+    return bad
+
+
+def run(folder, names, workers, cold):
+    """Scan the corpus once → (elapsed s, storage bytes read or None, peak RSS bytes or None, results)"""
+    paths = [os.path.join(folder, n) for n in names]
+    cold = cold and evict(paths)
+    pool = checker.pool_of(workers) if workers > 1 else None
+    try:
+        if pool: pool.map(abs, range(workers * 4))  # Start the workers outside the timing
+        pids = [os.getpid()] + ([p.pid for p in pool._pool] if pool else [])
+        try:
+            with open('/proc/self/clear_refs', 'w') as f: f.write('5')  # Reset this process's peak RSS
+        except OSError: pass
+        before = [proc_stats(pid) for pid in pids]
+        start = time.perf_counter()
+        results = list(checker.scan(paths, workers, pool))
+        elapsed = time.perf_counter() - start
+        after = [proc_stats(pid) for pid in pids]
+    finally:
+        if pool: pool.terminate()
+    if None in before or None in after: return elapsed, None, None, results
+    read = sum(a[0] - b[0] for a, b in zip(after, before)) if cold else None
+    return elapsed, read, sum(a[1] for a in after), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cameraMetadataChecker on a synthetic JPEG corpus")
+    parser.add_argument("--images", type=int, default=480, help="Number of images to generate (default: 480)")
+    parser.add_argument("--size-kb", type=int, default=1024, help="Size of each valid JPEG in KB (default: 1024)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Workers for the parallel run (default: CPU count)")
+    parser.add_argument("--folder", help="Corpus folder (default: a temporary folder, deleted afterwards)")
+    parser.add_argument("--warm", action="store_true", help="Leave the corpus in the page cache (MB read is then not measured)")
+    args = parser.parse_args()
+
+    folder = args.folder or tempfile.mkdtemp(prefix="jpeg_corpus_")
+    try:
+        print(f"Writing {args.images} synthetic image(s) of {args.size_kb} KB to {folder}...")
+        expected = make_corpus(folder, args.images, args.size_kb * 1024)
+        names = sorted(expected)
+
+        failed = 0
+        print(f"\n{'mode':<12}{'workers':>8}{'images/s':>11}{'MB read/img':>13}{'peak RSS MB':>13}{'mismatches':>12}")
+        for mode, workers in [('sequential', 1), ('parallel', max(2, args.workers))]:
+            elapsed, read, rss, results = run(folder, names, workers, not args.warm)
+            bad = {n: differences(r, expected[n]) for n, r in zip(names, results)}
+            bad = {n: d for n, d in bad.items() if d}
+            failed += len(bad)
+            print(f"{mode:<12}{workers:>8}{len(names) / elapsed:>11.0f}"
+                  f"{read / len(names) / 2**20 if read is not None else float('nan'):>13.3f}"
+                  f"{rss / 2**20 if rss is not None else float('nan'):>13.1f}{len(bad):>12}")
+            for n, d in list(bad.items())[:10]: print(f"    {n}: {'; '.join(d)}")
+
+        print(f"\n{'✓ All results match the fixtures' if not failed else f'✗ {failed} result(s) differ from the fixtures'}")
+        return 1 if failed else 0
+    finally:
+        if not args.folder: shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__": sys.exit(main())
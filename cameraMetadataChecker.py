@@ -1,91 +1,477 @@
 """Check images for GPS coordinates, camera orientation (roll/pitch/yaw), and sensor specs"""
-import os, struct, csv
+import os, re, mmap, struct, csv, time, calendar, sqlite3, select, signal, ctypes, ctypes.util
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:  # Only needed with EXTRACT
+    np = None
+
+try:
+    import pyarrow as pa, pyarrow.parquet as pq
+except ImportError:  # Columns are saved as .npz instead
+    pa = pq = None
 
 IMAGE_FOLDER = r"SOMEFOLDER"
+WORKERS = os.cpu_count() or 1  # 1 = check images one at a time in this process
+PRUNE = True  # Drop index entries for images no longer in the folder
+WATCH = False  # Keep running and check images as they are copied in (Ctrl+C to stop)
+POLL_INTERVAL = 2.0  # Watch: seconds between folder scans when inotify isn't available
+SETTLE = 1.0  # Watch: seconds a file's size and mtime must stay unchanged before it is checked
+EXTRACT = False  # Also save the decoded values as columns (Parquet, or .npz without pyarrow) and run flight QA (needs numpy)
+
+# Flight QA limits; a flight is the images of one folder in capture-time order
+ALT_MAD_LIMIT = 3.5  # Altitude outlier: robust z-score (median/MAD) above this
+MAX_SPEED = 30.0  # GPS jump: implied speed from the previous frame above this, m/s
+GAP_FACTOR = 1.8  # Overlap gap: distance from the previous frame above this many times the flight's median spacing (1 missed frame = 2x)
+
+# Results are kept in the image folder keyed by relative path, size and mtime so reruns only read new or changed images
+INDEX_NAME = ".image_metadata_index.sqlite"
+INDEX_VERSION = 3  # Bump when check_image changes so old results are thrown away
 
 # EXIF tag hex codes for finding metadata
 TAGS = {'make': 0x010F, 'model': 0x0110, 'exif_ifd': 0x8769, 'gps_ifd': 0x8825,
-        'focal': 0x920A, 'sensor_w': 0xA002, 'lat': 0x0002, 'lon': 0x0004, 'alt': 0x0006}
+        'focal': 0x920A, 'sensor_w': 0xA002, 'lat_ref': 0x0001, 'lat': 0x0002, 'lon_ref': 0x0003, 'lon': 0x0004,
+        'alt_ref': 0x0005, 'alt': 0x0006, 'time': 0x9003, 'subsec': 0x9291}
+
+# Precompiled structs per byte order, read straight out of the memory-mapped file with unpack_from
+U16 = {o: struct.Struct(o + 'H') for o in '<>'}
+U32 = {o: struct.Struct(o + 'I') for o in '<>'}
+ENTRY = {o: struct.Struct(o + 'HHII') for o in '<>'}  # tag, type, count, value or offset
+VALUES = {o: {3: struct.Struct(o + 'H'), 4: struct.Struct(o + 'I'), 5: struct.Struct(o + 'II'),
+              8: struct.Struct(o + 'h'), 9: struct.Struct(o + 'i'), 10: struct.Struct(o + 'ii'),
+              13: struct.Struct(o + 'I')} for o in '<>'}
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 13: 4}
 
-def parse_tags(data, offset, order):
-    """Extract tag IDs from EXIF section"""
-    if offset + 2 > len(data): return {}
+def parse_tags(buf, base, end, offset, order):
+    """IFD at base+offset → {tag id: (type, count, absolute position of its value)}"""
+    p = base + offset
+    if offset <= 0 or p + 2 > end: return {}
     tags = {}
-    for i in range(struct.unpack(order + 'H', data[offset:offset+2])[0]):
-        p = offset + 2 + i*12
-        if p + 12 > len(data): break
-        tid = struct.unpack(order + 'H', data[p:p+2])[0]
-        ttype = struct.unpack(order + 'H', data[p+2:p+4])[0]
-        tags[tid] = struct.unpack(order + 'I', data[p+8:p+12])[0] if ttype == 4 else True
+    for i in range(U16[order].unpack_from(buf, p)[0]):
+        q = p + 2 + i*12
+        if q + 12 > end: break
+        tid, ttype, count, value = ENTRY[order].unpack_from(buf, q)
+        tags[tid] = (ttype, count, q + 8 if TYPE_SIZES.get(ttype, 0) * count <= 4 else base + value)
     return tags
 
 
+def tag_value(buf, end, entry, order):
+    """Decode an IFD entry: ASCII → str, integers → int, rationals → float; several values → tuple"""
+    ttype, count, pos = entry
+    if ttype not in TYPE_SIZES or not count or pos + TYPE_SIZES[ttype] * count > end: return None
+    if ttype == 2: return buf[pos:pos+count].split(b'\x00', 1)[0].decode('utf-8', 'replace').strip() or None
+    if ttype in (1, 6, 7): values = tuple(buf[pos:pos+count])
+    else:
+        s = VALUES[order][ttype]
+        values = [s.unpack_from(buf, pos + i*s.size) for i in range(count)]
+        values = tuple(v[0] / v[1] if v[1] else None for v in values) if ttype in (5, 10) else tuple(v[0] for v in values)
+    return values[0] if count == 1 else values
+
+
+def text(value):
+    """Tag value if it decoded to a string (a malformed tag can decode to numbers), else None"""
+    return value if isinstance(value, str) else None
+
+
+def number(value):
+    """Tag value if it decoded to one number (not a tuple), else None"""
+    return value if isinstance(value, (int, float)) else None
+
+
+def degrees(dms, ref):
+    """GPS (degrees, minutes, seconds) rationals + N/S/E/W ref → signed decimal degrees"""
+    if not isinstance(dms, tuple) or len(dms) != 3 or None in dms: return None
+    value = dms[0] + dms[1] / 60 + dms[2] / 3600
+    return -value if ref in ('S', 'W') else value
+
+
+def capture_time(text, subsec):
+    """EXIF DateTimeOriginal 'YYYY:MM:DD HH:MM:SS' (+ SubSecTimeOriginal) → seconds since the epoch, camera clock as UTC"""
+    try: seconds = calendar.timegm(time.strptime(text, '%Y:%m:%d %H:%M:%S'))
+    except (TypeError, ValueError): return None
+    return seconds + float('0.' + subsec) if isinstance(subsec, str) and subsec.isdigit() else float(seconds)
+
+
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+SOS, EOI = 0xDA, 0xD9
+
+# XMP names holding each angle, in order of preference (DJI gimbal, Pix4D/senseFly camera, DJI airframe)
+ORIENTATION_NAMES = {'roll': ('GimbalRollDegree', 'Roll', 'FlightRollDegree'),
+                     'pitch': ('GimbalPitchDegree', 'Pitch', 'FlightPitchDegree'),
+                     'yaw': ('GimbalYawDegree', 'Yaw', 'FlightYawDegree')}
+
+def read_app1(buf):
+    """Walk JPEG segment markers from the file start → (exif, xmp) (start, end) offsets of the APP1 payloads; stops at SOS"""
+    if buf[:2] != b'\xff\xd8': return None
+    exif = xmp = None
+    pos, end = 2, len(buf)
+    while (exif is None or xmp is None) and pos + 2 <= end:
+        if buf[pos] != 0xFF: break  # Corrupt: not a marker
+        marker = buf[pos + 1]
+        pos += 2
+        if marker == 0xFF:  # Fill byte before the marker code
+            pos -= 1
+            continue
+        if marker in (SOS, EOI): break
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7: continue  # Markers without a length
+        if pos + 2 > end: break
+        start = pos + 2
+        pos += U16['>'].unpack_from(buf, pos)[0]
+        if marker == 0xE1:
+            stop = min(pos, end)  # A truncated file keeps what is there
+            if exif is None and buf[start:start+6] == b'Exif\x00\x00': exif = (start + 6, stop)
+            elif xmp is None and buf[start:start+len(XMP_HEADER)] == XMP_HEADER: xmp = (start + len(XMP_HEADER), stop)
+    return exif, xmp
+
+def parse_xmp_orientation(xmp):
+    """Roll/pitch/yaw from XMP attributes or elements → {axis: degrees} for the angles found"""
+    values = {}
+    try:
+        for el in ET.fromstring(xmp.strip(b'\x00 \t\r\n')).iter():
+            for k, v in el.attrib.items(): values.setdefault(k.rsplit('}', 1)[-1], v)
+            if el.text and el.text.strip(): values.setdefault(str(el.tag).rsplit('}', 1)[-1], el.text.strip())
+    except ET.ParseError:  # malformed packet: fall back to prefix:Name="value" attributes
+        values = {k.decode(): v.decode('utf-8', 'replace') for k, v in re.findall(rb'[\w-]+:(\w+)\s*=\s*"([^"]*)"', xmp)}
+    angles = {}
+    for axis, names in ORIENTATION_NAMES.items():
+        for name in names:
+            try:
+                angles[axis] = float(values[name])
+                break
+            except (KeyError, ValueError): pass
+    return angles
+
+
+EMPTY = {'gps': False, 'orientation': False, 'sensor': False, 'lat': None, 'lon': None, 'alt': None,
+         'roll': None, 'pitch': None, 'yaw': None, 'make': None, 'model': None, 'focal': None, 'time': None}
+
 def check_image(path):
-    """Check single image → return {gps, orientation, sensor}"""
+    """Check single image → return {gps, orientation, sensor} plus the decoded values behind them"""
     try:
-        with open(path, 'rb') as f:
-            data = f.read(min(os.path.getsize(path), 50*1024*1024))  # Max 50MB
-        
-        if data[:2] != b'\xff\xd8': return {k: False for k in ['gps', 'orientation', 'sensor']}
-        
-        # Orientation: must have roll, pitch, yaw
-        orientation = all(x in data for x in [b'RollDegree="', b'PitchDegree="', b'YawDegree="'])
-        
-        # Parse EXIF
-        start = data.find(b'Exif\x00\x00')
-        if start == -1: return {'gps': False, 'orientation': orientation, 'sensor': False}
-        
-        exif = data[start + 6:]
-        if len(exif) < 8: return {'gps': False, 'orientation': orientation, 'sensor': False}
-        
-        order = '<' if exif[:2] == b'II' else '>'
-        if struct.unpack(order + 'H', exif[2:4])[0] != 0x002A:
-            return {'gps': False, 'orientation': orientation, 'sensor': False}
-        
-        main = parse_tags(exif, struct.unpack(order + 'I', exif[4:8])[0], order)
-        
-        # Sensor: need make/model + (focal or sensor width)
-        sensor = TAGS['make'] in main and TAGS['model'] in main
-        if sensor and TAGS['exif_ifd'] in main:
-            etags = parse_tags(exif, main[TAGS['exif_ifd']], order)
-            sensor = TAGS['focal'] in etags or TAGS['sensor_w'] in etags
-        
-        # GPS: need lat/lon/alt
-        gps = False
-        if TAGS['gps_ifd'] in main:
-            gtags = parse_tags(exif, main[TAGS['gps_ifd']], order)
-            gps = all(TAGS[k] in gtags for k in ['lat', 'lon', 'alt'])
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(mmap, 'MADV_RANDOM'): buf.madvise(mmap.MADV_RANDOM)  # Fault in only the header pages, no read-around
+            return parse_image(buf)
+    except Exception: return dict(EMPTY)  # Empty, unreadable or malformed file
+
+
+def parse_image(buf):
+    """Decode EXIF/XMP from a JPEG buffer; only the header pages of a memory-mapped file are touched"""
+    m = dict(EMPTY)
+    segments = read_app1(buf)
+    if segments is None: return m
+    exif, xmp = segments
+    
+    # Orientation: must have roll, pitch, yaw
+    if xmp is not None:
+        m.update(parse_xmp_orientation(buf[xmp[0]:xmp[1]]))
+        m['orientation'] = None not in (m['roll'], m['pitch'], m['yaw'])
+    
+    # Parse EXIF (offsets are relative to the TIFF header at base)
+    if exif is None or exif[1] - exif[0] < 8: return m
+    base, end = exif
+    order = '<' if buf[base:base+2] == b'II' else '>'
+    if U16[order].unpack_from(buf, base + 2)[0] != 0x002A: return m
+    
+    main = parse_tags(buf, base, end, U32[order].unpack_from(buf, base + 4)[0], order)
+    value = lambda tags, name: tag_value(buf, end, tags[TAGS[name]], order) if TAGS[name] in tags else None
+    
+    # Sensor: need make/model + (focal or sensor width)
+    m['make'], m['model'] = text(value(main, 'make')), text(value(main, 'model'))
+    etags = parse_tags(buf, base, end, value(main, 'exif_ifd') or 0, order) if TAGS['exif_ifd'] in main else {}
+    m['focal'] = number(value(etags, 'focal'))
+    m['time'] = capture_time(value(etags, 'time'), value(etags, 'subsec'))
+    m['sensor'] = bool(m['make'] and m['model'] and (m['focal'] or TAGS['sensor_w'] in etags))
+    
+    # GPS: need lat/lon/alt
+    if TAGS['gps_ifd'] in main:
+        gtags = parse_tags(buf, base, end, value(main, 'gps_ifd') or 0, order)
+        m['lat'] = degrees(value(gtags, 'lat'), value(gtags, 'lat_ref'))
+        m['lon'] = degrees(value(gtags, 'lon'), value(gtags, 'lon_ref'))
+        m['alt'] = number(value(gtags, 'alt'))
+        if m['alt'] is not None and value(gtags, 'alt_ref') == 1: m['alt'] = -m['alt']  # Below sea level
+        m['gps'] = None not in (m['lat'], m['lon'], m['alt'])
+    return m
+
+def scan(images, workers, pool=None):
+    """Yield check_image results in input order; with workers > 1 chunks of images go to a process pool (or the one given)"""
+    if workers <= 1:
+        yield from map(check_image, images)
+        return
+    chunk = max(1, min(256, len(images) // (workers * 8)))  # Big enough to keep IPC cheap, small enough to balance
+    if pool is not None:
+        yield from pool.imap(check_image, images, chunksize=chunk)
+        return
+    with pool_of(workers) as pool:
+        yield from pool.imap(check_image, images, chunksize=chunk)
+
+
+def pool_of(workers):
+    """Process pool whose workers leave Ctrl+C to the main process"""
+    return Pool(workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+
+FLAGS = ['gps', 'orientation', 'sensor']
+VALUES_SQL = {'lat': 'REAL', 'lon': 'REAL', 'alt': 'REAL', 'roll': 'REAL', 'pitch': 'REAL', 'yaw': 'REAL',
+              'focal': 'REAL', 'time': 'REAL', 'make': 'TEXT', 'model': 'TEXT'}
+
+def open_index(folder):
+    """Open (or create) the folder's scan index, emptying it if it was written by another INDEX_VERSION"""
+    db = sqlite3.connect(os.path.join(folder, INDEX_NAME))
+    if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        db.execute('DROP TABLE IF EXISTS images')
+        db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    db.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+               'gps INTEGER, orientation INTEGER, sensor INTEGER, ' + ', '.join(f'{k} {t}' for k, t in VALUES_SQL.items()) + ')')
+    return db
+
+
+INSERT_SQL = f'INSERT OR REPLACE INTO images VALUES ({", ".join("?" * (3 + len(FLAGS) + len(VALUES_SQL)))})'
+CSV_HEADER = ['image_name', 'image_path', 'has_gps_xyz', 'has_camera_orientation', 'has_sensor_info']
+
+def index_row(rel, stamp, m):
+    return (rel, *stamp, *(m[k] for k in FLAGS), *(m[k] for k in VALUES_SQL))
+
+
+def find_jpegs(folder):
+    """Relative path → (size, mtime_ns) of every JPEG under folder, in walk order"""
+    files = {}
+    for r, _, fs in os.walk(folder):
+        for f in fs:
+            if not f.lower().endswith(('.jpg', '.jpeg')): continue
+            try: st = os.stat(os.path.join(r, f))
+            except OSError: continue  # Removed while walking
+            files[os.path.relpath(os.path.join(r, f), folder)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def columns(rows):
+    """Index rows (path, *VALUES_SQL) → dict of NumPy columns; missing numbers are NaN"""
+    paths = np.array([r[0] for r in rows], dtype=object)
+    numbers = np.array([r[1:9] for r in rows], dtype=float).reshape(-1, 8)  # None → NaN
+    cols = {'path': paths, 'flight': np.array([os.path.dirname(p) for p in paths], dtype=object)}
+    cols.update({k: numbers[:, i] for i, k in enumerate(list(VALUES_SQL)[:8])})
+    cols['make'] = np.array([r[9] for r in rows], dtype=object)
+    cols['model'] = np.array([r[10] for r in rows], dtype=object)
+    return cols
+
+
+def flight_qa(cols):
+    """Vectorized QA within each flight (folder, in capture-time order) → dict of boolean columns"""
+    n = len(cols['path'])
+    qa = {k: np.zeros(n, bool) for k in ['qa_alt_outlier', 'qa_gps_jump', 'qa_duplicate_time', 'qa_overlap_gap']}
+    if n == 0: return qa
+    flight = np.unique(cols['flight'], return_inverse=True)[1].ravel()
+    order = np.lexsort((cols['time'], flight))  # NaN times sort last within their flight
+    f, t = flight[order], cols['time'][order]
+    lat, lon, alt = np.radians(cols['lat'][order]), np.radians(cols['lon'][order]), cols['alt'][order]
+    
+    # Consecutive frames of the same flight: haversine distance (m) and time step (s)
+    same = f[1:] == f[:-1]
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[1:]) * np.cos(lat[:-1]) * np.sin(np.diff(lon) / 2) ** 2
+    dist = np.where(same, 2 * 6371008.8 * np.arcsin(np.sqrt(np.clip(a, 0, 1))), np.nan)
+    dt = np.where(same, np.diff(t), np.nan)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        jump = (dt > 0) & (dist / dt > MAX_SPEED)
+        duplicate = dt == 0
         
-        return {'gps': gps, 'orientation': orientation, 'sensor': sensor}
+        # Per-flight medians of altitude, its absolute deviation and frame spacing, broadcast back to every frame
+        counts = np.bincount(f)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        median = lambda x: np.nanmedian(x) if np.isfinite(x).any() else np.nan
+        alt_median, mad, spacing = (np.full(len(counts), np.nan) for _ in range(3))
+        for g, (s, c) in enumerate(zip(starts, counts)):  # One pass per flight, not per image
+            alt_median[g] = median(alt[s:s+c])
+            mad[g] = median(np.abs(alt[s:s+c] - alt_median[g]))
+            spacing[g] = median(dist[s:s+c-1])  # Steps between this flight's frames
+        robust_z = 0.6745 * np.abs(alt - alt_median[f]) / np.where(mad[f] > 0, mad[f], np.nan)
+        outlier = robust_z > ALT_MAD_LIMIT
+        gap = ~jump & (dist > GAP_FACTOR * spacing[f[1:]])
+    
+    flags = {'qa_alt_outlier': outlier,
+             'qa_gps_jump': np.concatenate(([False], jump)),  # Flag the frame that arrived at the jump
+             'qa_duplicate_time': np.concatenate(([False], duplicate)) | np.concatenate((duplicate, [False])),
+             'qa_overlap_gap': np.concatenate(([False], gap))}
+    for k, v in flags.items(): qa[k][order] = v
+    return qa
+
+
+def extract_columns(folder, rows):
+    """Save decoded values + flight QA flags as columns next to the CSV and print the QA totals"""
+    if np is None: return print("EXTRACT needs numpy: pip install numpy")
+    cols = columns(rows)
+    cols.update(flight_qa(cols))
+    cols['time'] = (cols['time'] * 1000).astype('datetime64[ms]')  # NaN → NaT
+    
+    if pa is not None:
+        out = os.path.join(folder, "image_metadata.parquet")
+        pq.write_table(pa.table({k: pa.array(v, from_pandas=True) for k, v in cols.items()}), out)
+    else:
+        out = os.path.join(folder, "image_metadata.npz")
+        np.savez(out, **{k: np.where(np.equal(v, None), '', v).astype(str) if v.dtype == object else v for k, v in cols.items()})
     
-    except: return {'gps': False, 'orientation': False, 'sensor': False}
+    print(f"\n✓ Saved: {out}")
+    print("QA: " + " | ".join(f"{k[3:].replace('_', ' ')}: {int(cols[k].sum())}" for k in cols if k.startswith('qa_')))
 
 
-def main(folder):
-    """Process: find JPEGs → check metadata → save CSV"""
+def main(folder, workers=WORKERS, prune=PRUNE, extract=EXTRACT):
+    """Process: find JPEGs → check new/changed ones (in parallel) into the index → rebuild CSV from the index"""
     if not os.path.exists(folder): return print(f"Error: '{folder}' not found!")
     
-    images = [os.path.join(r,f) for r,_,fs in os.walk(folder) for f in fs if f.lower().endswith(('.jpg','.jpeg'))]
-    if not images: return print("No JPEGs found")
+    files = find_jpegs(folder)
+    if not files: return print("No JPEGs found")
     
-    print(f"Checking {len(images)} image(s)...\n")
+    db = open_index(folder)
+    known = {p: (size, mtime) for p, size, mtime in db.execute('SELECT path, size, mtime_ns FROM images')}
+    todo = [p for p, stamp in files.items() if known.get(p) != stamp]
     
-    results = []
-    for i, path in enumerate(images, 1):
-        name = os.path.basename(path)
-        m = check_image(path)
-        results.append({'image_name': name, 'image_path': os.path.relpath(path, folder),
-                       'has_gps_xyz': m['gps'], 'has_camera_orientation': m['orientation'], 
-                       'has_sensor_info': m['sensor']})
-        print(f"  [{i}/{len(images)}] {name}... GPS:{m['gps']}, Orient:{m['orientation']}, Sensor:{m['sensor']}")
+    workers = max(1, min(workers, len(todo)))
+    print(f"Checking {len(todo)} new or changed of {len(files)} image(s) with {workers} worker(s)...\n")
+    
+    totals = {'gps': 0, 'orientation': 0, 'sensor': 0}
+    rows = []
+    start = last = time.time()
+    for i, (rel, m) in enumerate(zip(todo, scan([os.path.join(folder, p) for p in todo], workers)), 1):
+        rows.append(index_row(rel, files[rel], m))
+        for k in totals: totals[k] += m[k]
+        if time.time() - last >= 0.5 or i == len(todo):  # One progress line, redrawn at most twice a second
+            last = time.time()
+            db.executemany(INSERT_SQL, rows)
+            db.commit()  # An interrupted run keeps what it has checked so far
+            rows = []
+            print(f"\r  [{i}/{len(todo)}] {i / max(last - start, 1e-6):.0f} img/s | GPS:{totals['gps']} Orient:{totals['orientation']} Sensor:{totals['sensor']}", end='', flush=True)
+    if todo: print()
+    
+    if prune:
+        stale = [(p,) for p in known if p not in files]
+        db.executemany('DELETE FROM images WHERE path = ?', stale)
+        db.commit()
+        if stale: print(f"Pruned {len(stale)} index entr{'y' if len(stale) == 1 else 'ies'} for missing images")
+    
+    index = {p: row for p, *row in db.execute(f'SELECT path, {", ".join(FLAGS + list(VALUES_SQL))} FROM images')}
+    db.close()
     
     out = os.path.join(folder, "image_metadata_check.csv")
+    totals = {'gps': 0, 'orientation': 0, 'sensor': 0}
     with open(out, 'w', newline='', encoding='utf-8') as f:
-        w = csv.DictWriter(f, ['image_name', 'image_path', 'has_gps_xyz', 'has_camera_orientation', 'has_sensor_info'])
-        w.writeheader()
-        w.writerows(results)
+        w = csv.writer(f)
+        w.writerow(CSV_HEADER)
+        for rel in files:
+            flags = [bool(x) for x in index[rel][:len(FLAGS)]]
+            w.writerow([os.path.basename(rel), rel, *flags])
+            for k, x in zip(totals, flags): totals[k] += x
     
     print(f"\n✓ Saved: {out}\n")
-    print(f"Total: {len(results)} | GPS: {sum(r['has_gps_xyz'] for r in results)} | Orient: {sum(r['has_camera_orientation'] for r in results)} | Sensor: {sum(r['has_sensor_info'] for r in results)}")
+    print(f"Total: {len(files)} | GPS: {totals['gps']} | Orient: {totals['orientation']} | Sensor: {totals['sensor']}")
+    
+    if extract: extract_columns(folder, [(rel, *index[rel][len(FLAGS):]) for rel in files])
+
+
+class Inotify:
+    """Recursive inotify watch (Linux, through libc) reporting files that were created, written or moved in"""
+    MASK = 0x100 | 0x8 | 0x80  # IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+    
+    def __init__(self, folder):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)  # AttributeError where libc has no inotify
+        if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.overflow = False  # Events were dropped; the caller should rescan the folder
+        for r, _, _ in os.walk(folder): self.add(r)
+    
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd >= 0: self.dirs[wd] = path
+    
+    def read(self, timeout):
+        """Paths reported within timeout seconds; new subfolders are watched and their files reported too"""
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+        data, pos, paths = os.read(self.fd, 64 * 1024), 0, []
+        while pos + 16 <= len(data):
+            wd, mask, _, size = self.EVENT.unpack_from(data, pos)
+            path = os.path.join(self.dirs.get(wd, ''), os.fsdecode(data[pos+16:pos+16+size].split(b'\x00', 1)[0]))
+            pos += 16 + size
+            if mask & 0x4000: self.overflow = True  # IN_Q_OVERFLOW
+            elif mask & 0x40000000:  # IN_ISDIR: files may land before the watch is in place
+                for r, _, fs in os.walk(path):
+                    self.add(r)
+                    paths += [os.path.join(r, f) for f in fs]
+            elif wd in self.dirs: paths.append(path)
+        return paths
+    
+    def close(self): os.close(self.fd)
+
+
+def watch(folder, workers=WORKERS, poll=POLL_INTERVAL, settle=SETTLE):
+    """Check images as they are copied in: append rows to the CSV and keep running totals; Ctrl+C rebuilds the CSV"""
+    if not os.path.exists(folder): return print(f"Error: '{folder}' not found!")
+    main(folder, workers)  # Catch up on what is already there
+    
+    db = open_index(folder)
+    known = {p: (size, mtime) for p, size, mtime in db.execute('SELECT path, size, mtime_ns FROM images')}
+    try:
+        notifier = Inotify(folder)
+        print(f"\nWatching {folder} (inotify, Ctrl+C to stop)...\n")
+    except (OSError, AttributeError, TypeError):
+        notifier = None
+        print(f"\nWatching {folder} (polling every {poll:g}s, Ctrl+C to stop)...\n")
+    
+    out = os.path.join(folder, "image_metadata_check.csv")
+    new_csv = not os.path.exists(out)
+    pending = {}  # relative path → (size/mtime last seen, when it last changed)
+    checked, last_scan, start = 0, 0.0, time.time()
+    with pool_of(workers) as pool, open(out, 'a', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        if new_csv: w.writerow(CSV_HEADER)
+        try:
+            while True:
+                paths = notifier.read(settle / 2) if notifier else []
+                if notifier is None: time.sleep(settle / 2)
+                now = time.time()
+                if notifier.overflow if notifier else now - last_scan >= poll:  # Polling, or inotify dropped events
+                    paths = [os.path.join(folder, p) for p, stamp in find_jpegs(folder).items() if known.get(p) != stamp]
+                    last_scan = now
+                    if notifier: notifier.overflow = False
+                
+                for path in paths:
+                    if path.lower().endswith(('.jpg', '.jpeg')): pending.setdefault(os.path.relpath(path, folder), (None, now))
+                
+                # Debounce: a file is ready once its size and mtime have held still for settle seconds
+                ready = []
+                for rel, (stamp, since) in list(pending.items()):
+                    try: st = os.stat(os.path.join(folder, rel))
+                    except OSError:
+                        del pending[rel]  # Gone (or renamed) before it settled
+                        continue
+                    current = (st.st_size, st.st_mtime_ns)
+                    if current != stamp: pending[rel] = (current, now)
+                    elif now - since >= settle:
+                        del pending[rel]
+                        if current[0] and known.get(rel) != current: ready.append((rel, current))
+                if not ready: continue
+                
+                results = pool.map(check_image, [os.path.join(folder, rel) for rel, _ in ready],
+                                   chunksize=max(1, len(ready) // (workers * 4)))
+                db.executemany(INSERT_SQL, [index_row(rel, stamp, m) for (rel, stamp), m in zip(ready, results)])
+                db.commit()
+                for (rel, stamp), m in zip(ready, results):
+                    w.writerow([os.path.basename(rel), rel, m['gps'], m['orientation'], m['sensor']])
+                    known[rel] = stamp
+                f.flush()
+                
+                checked += len(ready)
+                total, gps, orient, sensor = db.execute('SELECT COUNT(*), SUM(gps), SUM(orientation), SUM(sensor) FROM images').fetchone()
+                print(f"\r  +{checked} new ({checked / max(time.time() - start, 1e-6) * 60:.0f}/min) | "
+                      f"Total: {total} | GPS: {gps} | Orient: {orient} | Sensor: {sensor} | waiting: {len(pending)}  ", end='', flush=True)
+        except KeyboardInterrupt:
+            print("\n\nStopping...")
+    
+    db.close()
+    if notifier: notifier.close()
+    main(folder, workers)  # Rewritten files were appended twice; rebuild the CSV from the index and prune
+
 
-if __name__ == "__main__": main(IMAGE_FOLDER)
+if __name__ == "__main__": watch(IMAGE_FOLDER) if WATCH else main(IMAGE_FOLDER)
@@ -0,0 +1,250 @@
+"""On-disk HTTP cache shared by the REST download scripts.
+
+Mount CachingAdapter on a requests session and GETs of metadata endpoints (layer/service info, counts,
+ObjectID lists, SiteScan missions and organizations) are answered from disk while they are fresh. Once
+an entry's time-to-live for its endpoint class runs out it is revalidated with If-None-Match /
+If-Modified-Since, so an unchanged response costs a 304 instead of the whole body. Everything else,
+including query pages, goes straight to the server. Entries are evicted least recently used first
+past a byte budget, and each cache counts its hits, revalidations and misses.
+"""
+import os
+import re
+import io
+import json
+import gzip
+import time
+import hashlib
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:  # Python 2
+    from urlparse import urlsplit, parse_qsl
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".rest_http_cache")
+MAX_CACHE_BYTES = 256 * 1024 ** 2
+
+# Seconds a response is served without asking the server; None means it is never cached
+ENDPOINT_TTLS = {
+    "service": 600,         # MapServer/FeatureServer and layer metadata (maxRecordCount, fields, edit dates)
+    "count": 300,           # returnCountOnly
+    "ids": 300,             # returnIdsOnly
+    "organizations": 86400,  # SiteScan organization list
+    "mission": 30,          # SiteScan mission, polled while processing
+}
+
+# Only these headers are kept with a cached body
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+def _replace(source, target):
+    try:
+        os.replace(source, target)
+    except AttributeError:  # Python 2 has no os.replace and rename won't overwrite on Windows
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+def endpoint_class(url):
+    """Name of the ENDPOINT_TTLS class a GET url belongs to, or None if it shouldn't be cached"""
+    parts = urlsplit(url)
+    params = dict((k.lower(), v.lower()) for k, v in parse_qsl(parts.query))
+    path = parts.path.rstrip("/")
+    if params.get("returncountonly") == "true":
+        return "count"
+    if params.get("returnidsonly") == "true":
+        return "ids"
+    if re.search(r"/(MapServer|FeatureServer)(/\d+)?(/layers)?$", path, re.IGNORECASE):
+        return "service"
+    if re.search(r"/missions/[^/]+$", path):
+        return "mission"
+    if path.endswith("/organizations"):
+        return "organizations"
+    return None
+
+
+class DiskStore(object):
+    """Directory of gzip entries, each one JSON header line followed by the body, evicted least
+    recently used first past max_bytes. HttpCache and SNBPropertyDataDownloader's PageCache build on it."""
+
+    def __init__(self, cache_dir, max_bytes, suffix):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created by another process in the meantime
+                pass
+
+    def entry_path(self, key):
+        """Path of the entry for a JSON-serialisable key"""
+        return os.path.join(self.cache_dir, hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest() + self.suffix)
+
+    def load(self, path):
+        """(header dict, body) of an entry, or None"""
+        try:
+            with gzip.open(path, "rb") as f:
+                header = json.loads(f.readline().decode("utf-8"))
+                body = f.read()
+            os.utime(path, None)  # Mark as recently used for eviction
+            return header, body
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, path, header, body):
+        # Write to a temporary file first so an interrupted run never leaves half an entry behind
+        tmp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(body)
+        _replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(self.suffix):
+                    path = os.path.join(self.cache_dir, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith((self.suffix, ".tmp")):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+class HttpCache(DiskStore):
+    """Cached GET responses as gzip files of one JSON header line followed by the body"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, ttls=None):
+        super(HttpCache, self).__init__(cache_dir, max_bytes, ".cache")
+        self.ttls = dict(ENDPOINT_TTLS, **(ttls or {}))
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def ttl(self, url):
+        kind = endpoint_class(url)
+        return None if kind is None else self.ttls.get(kind)
+
+    def path(self, url, authorization=None):
+        # The credentials are part of the key (hashed) so one user's responses are never served to another
+        return self.entry_path([url, authorization or ""])
+
+    def store(self, path, url, headers, body):
+        header = {"url": url, "stored": time.time(),
+                  "headers": dict((name, headers[name]) for name in KEPT_HEADERS if name in headers)}
+        self.save(path, header, body)
+
+    def touch(self, path, header, body):
+        """Restart an entry's time-to-live after the server confirmed it is unchanged"""
+        self.store(path, header["url"], header["headers"], body)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def summary(self):
+        return "http cache: {} hits, {} revalidated, {} misses".format(self.hits, self.revalidated, self.misses)
+
+
+_default_cache = None
+
+
+def default_cache():
+    """The cache in CACHE_DIR that every script shares unless it is given its own"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = HttpCache()
+    return _default_cache
+
+
+def _is_error(headers, body):
+    # ArcGIS reports errors (including throttling) as JSON with HTTP 200; those must not be cached
+    return "json" in headers.get("Content-Type", "") and re.match(br'\s*\{\s*"error"', body) is not None
+
+
+class CachingAdapter(HTTPAdapter):
+    """HTTPAdapter that answers cacheable GETs from an HttpCache (the shared default one if not given)"""
+
+    def __init__(self, cache=None, **kwargs):
+        self.cache = cache or default_cache()
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        ttl = self.cache.ttl(request.url) if request.method == "GET" else None
+        if ttl is None:
+            return super(CachingAdapter, self).send(request, **kwargs)
+
+        path = self.cache.path(request.url, request.headers.get("Authorization"))
+        entry = self.cache.load(path)
+        if entry is not None:
+            header, body = entry
+            if time.time() - header["stored"] < ttl:
+                self.cache.count("hits")
+                return self._cached_response(request, header, body)
+            validators = header["headers"]
+            if "ETag" in validators:
+                request.headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                request.headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        response = super(CachingAdapter, self).send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.count("revalidated")
+            self.cache.touch(path, header, body)
+            return self._cached_response(request, header, body)
+
+        self.cache.count("misses")
+        if response.status_code == 200 and not kwargs.get("stream"):
+            body = response.content
+            if not _is_error(response.headers, body):
+                self.cache.store(path, request.url, response.headers, body)
+        return response
+
+    def _cached_response(self, request, header, body):
+        response = Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(header["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(b"")  # Nothing came over the wire
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        return response
+
+
+def mount(session, cache=None, **adapter_kwargs):
+    """Route a session's http and https requests through a CachingAdapter; returns the cache"""
+    adapter = CachingAdapter(cache, **adapter_kwargs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return adapter.cache
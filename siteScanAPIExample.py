@@ -22,10 +22,19 @@ import requests
 import os
 import shutil
 import tempfile
-from datetime import time
+import time
 from arcgis.gis import GIS
 from arcgis.raster.analytics import copy_raster
 
+# the organization list and mission status are cached on disk between runs
+# and polls when httpCache.py is next to this script
+session = requests.Session()
+try:
+    import httpCache
+    httpCache.mount(session)
+except ImportError:
+    httpCache = None
+
 ###############################################################################
 # functions ###################################################################
 ###############################################################################
@@ -33,8 +42,8 @@ from arcgis.raster.analytics import copy_raster
 def getOrgID(token, url):
     # Get organization id
     orgRequestURL = f'{url}/organizations'
-    response = requests.get(url=orgRequestURL, 
-                            headers={'Authorization': f'Bearer {token}'})
+    response = session.get(url=orgRequestURL, 
+                           headers={'Authorization': f'Bearer {token}'})
     data = response.json()
     for item in data:
         organization_id = item.get('id')
@@ -101,14 +110,14 @@ def startProcessing(token, url, mission_id):
 def checkProcessingStatus(token, url, mission_id):
     # Check the processing status of the mission
     missionURL = f'{url}/missions/{mission_id}'
-    response = requests.get(missionURL, headers={'Authorization': f'Bearer {token}'})
+    response = session.get(missionURL, headers={'Authorization': f'Bearer {token}'})
     if response.status_code == 200:
         productList = [['Ortho', 'ortho'], ['DTM', 'dtm'], ['DSM', 'dem']]
         productURLs = []
         for product in productList:
             success = False
             while success == False:
-                response = requests.get(missionURL, headers={'Authorization': f'Bearer {token}'})
+                response = session.get(missionURL, headers={'Authorization': f'Bearer {token}'})
                 mission_data = response.json()
                 productURL = mission_data.get('data', {}).get(product[1], {}).get('current', {}).get('url')
                 if productURL:
@@ -211,4 +220,7 @@ for fileToUpload in localFiles:
         print(f"Uploaded {fileToUpload[0]} to ArcGIS Portal!")
 
 deleteTempFolder(temp_dir)
+
+if httpCache is not None:
+    print(httpCache.default_cache().summary())
 ###############################################################################